@@ -0,0 +1,48 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import configuration
+from data_management import sql_utilities, archive
+
+log = logging.getLogger("Archive Data")
+
+
+async def run_archive(config: dict, device_ids: list[str] = None, tables: list[str] = None,
+                      until: datetime.datetime = None):
+    # Exports whatever closed periods haven't been archived yet, once, using the same settings as the daemon's job
+    archive_config = config.get("archive", {})
+    sql_config = config["sql_database"]
+    engine = sql_utilities.get_engine(
+        sql_utilities.get_read_connection_string(sql_config) or
+        sql_utilities.get_sql_connection_string(sql_config["sql_driver"], sql_config["database_path"]),
+        sql_config.get("pools", {}).get("read"), sql_config.get("sqlite_profile"))
+
+    try:
+        parquet_archiver = archive.ParquetArchiver(engine, device_ids or await archive.get_device_ids(engine),
+                                                   archive_directory=archive_config.get("directory", "archive"),
+                                                   interval=archive_config.get("interval", "daily"),
+                                                   tables=tables or archive_config.get("tables"),
+                                                   chunk_size=archive_config.get("chunk_size", 10000),
+                                                   compression=archive_config.get("compression", "zstd"),
+                                                   grace_period=archive_config.get("grace_period", 3600))
+        num_written = await parquet_archiver.archive(until.timestamp() if until else None)
+        log.info(f"Wrote {num_written} archive files")
+    finally:
+        await sql_utilities.dispose_engines()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export closed periods of the database to Parquet archives")
+    parser.add_argument('-c', '--config', help='Path to config file', default='config.yaml')
+    parser.add_argument('-d', '--device', help='Device to archive (all of them by default)', action='append')
+    parser.add_argument('-t', '--table', help='Table to archive (all of them by default)', action='append',
+                        choices=archive.ARCHIVE_TABLES)
+    parser.add_argument('-u', '--until', help='Only archive periods that end before this date (YYYY-MM-DD)',
+                        type=datetime.datetime.fromisoformat)
+    args = parser.parse_args()
+
+    config = configuration.load_config(args.config)
+    configuration.configure_logging(config)
+
+    asyncio.run(run_archive(config, args.device, args.table, args.until))
@@ -1,8 +1,11 @@
 from .devices import Device, DeviceType
 from .observers import CsvFileLoggingObserver, PrintObserver, WebsocketServer, WebsocketObserver, SQLDatabaseObserver, \
-    SQLSession, GridChangeNotificationObserver, LowBatteryNotificationObserver
+    SQLSession, GridChangeNotificationObserver, LowBatteryNotificationObserver, GridOutageObserver
 import asyncio
 from data_management import sql_utilities
+from data_management.partitions import PartitionManager
+from data_management.retention import RetentionEnforcer
+from data_management.archive import ParquetArchiver
 
 
 def attach_observers(devices: dict[str, Device], config: dict):
@@ -13,7 +16,8 @@ def attach_observers(devices: dict[str, Device], config: dict):
         [device.attach_observer(PrintObserver()) for device in devices.values()]
 
     if "csv_data_logging" in config:
-        [attach_csv_file_logging_observer(device, device_id, config) for device_id, device in devices.items()]
+        stop_functions += [attach_csv_file_logging_observer(device, device_id, config).stop for device_id, device in
+                           devices.items()]
 
     if "websocket_streaming" in config:
         websocket_message_queue = asyncio.Queue()
@@ -24,16 +28,82 @@ def attach_observers(devices: dict[str, Device], config: dict):
         stop_functions.append(websocket_server.stop)
 
     if "sql_database" in config:
+        sql_config = config["sql_database"]
+        rollup_tiers = sql_utilities.get_rollup_tiers(sql_config)
+        partitioning = sql_config.get("partitioning", {})
         sql_message_queue = asyncio.Queue()
-        connection_string = sql_utilities.get_sql_connection_string(config["sql_database"]["sql_driver"],
-                                                                    config["sql_database"]["database_path"])
-        sql_session = SQLSession(connection_string, sql_message_queue)
+        connection_string = sql_utilities.get_sql_connection_string(sql_config["sql_driver"],
+                                                                    sql_config["database_path"])
+        table_names = [table_name for device_id in devices for table_name in
+                       sql_utilities.get_device_table_names(device_id, rollup_tiers)] + \
+                      [sql_utilities.get_outage_table_name(device_id) for device_id, device in devices.items() if
+                       device.device_type == DeviceType.INVERTER]
+        sql_session = SQLSession(connection_string, sql_message_queue,
+                                 batch_size=sql_config.get("batch_size", 500),
+                                 flush_interval=sql_config.get("flush_interval", 1.0),
+                                 ingest_mode=sql_config.get("ingest_mode", "insert"),
+                                 epoch_millisecond_keys=sql_config.get("epoch_millisecond_keys", False),
+                                 sqlite_profile=sql_config.get("sqlite_profile"),
+                                 table_names=table_names,
+                                 pool_settings=sql_config.get("pools", {}).get("write"),
+                                 spool_settings=sql_config.get("spool"))
         [device.attach_observer(
-            SQLDatabaseObserver(device_id, sql_message_queue, sql_session.metadata, sql_session.ready)) for
+            SQLDatabaseObserver(device_id, sql_message_queue, sql_session.catalog, sql_session.ready,
+                                dialect_name=sql_session.engine.dialect.name,
+                                epoch_millisecond_keys=sql_session.epoch_millisecond_keys,
+                                rollup_tiers=rollup_tiers,
+                                partition_interval=partitioning.get("interval"),
+                                compact_arrays=sql_config.get("compact_arrays", False),
+                                ingest_compression=sql_config.get("ingest_compression"),
+                                spool_before_ready=sql_session.spool is not None,
+                                engine=sql_session.engine)) for
          device_id, device in devices.items()]
+        # Attached after the SQL observers, so that the view the outage observer looks back through exists first
+        [device.attach_observer(
+            GridOutageObserver(device_id, sql_message_queue, sql_session.catalog, sql_session.ready)) for
+         device_id, device in devices.items() if device.device_type == DeviceType.INVERTER]
         async_tasks.append(sql_session.run_session())
         stop_functions.append(sql_session.stop)
 
+        if partitioning and sql_session.engine.dialect.name == "postgresql":
+            partition_manager = PartitionManager(sql_session.engine,
+                                                 [sql_utilities.get_table_name(device_id) for device_id in devices],
+                                                 partitioning.get("interval", "daily"),
+                                                 partitioning.get("partitions_ahead", 2))
+            async_tasks.append(partition_manager.run())
+            stop_functions.append(partition_manager.stop)
+
+        if "retention" in config:
+            retention_config = config["retention"]
+            retention_enforcer = RetentionEnforcer(sql_session.engine, list(devices.keys()),
+                                                   raw_days=retention_config.get("raw_days"),
+                                                   rollup_days=retention_config.get("rollup_days"),
+                                                   partition_interval=partitioning.get("interval"),
+                                                   detach_expired=partitioning.get("detach_expired", False),
+                                                   chunk_size=retention_config.get("chunk_size", 5000),
+                                                   chunk_pause=retention_config.get("chunk_pause", 0.1),
+                                                   check_interval=retention_config.get("check_interval", 3600),
+                                                   vacuum=retention_config.get("vacuum", True))
+            async_tasks.append(retention_enforcer.run())
+            stop_functions.append(retention_enforcer.stop)
+
+        if "archive" in config:
+            archive_config = config["archive"]
+            # Exports stream whole days out of the database, so they go through the query pool rather than ingest's
+            archive_engine = sql_utilities.get_engine(
+                sql_utilities.get_read_connection_string(sql_config) or connection_string,
+                sql_config.get("pools", {}).get("read"), sql_config.get("sqlite_profile"))
+            parquet_archiver = ParquetArchiver(archive_engine, list(devices.keys()),
+                                               archive_directory=archive_config.get("directory", "archive"),
+                                               interval=archive_config.get("interval", "daily"),
+                                               tables=archive_config.get("tables"),
+                                               chunk_size=archive_config.get("chunk_size", 10000),
+                                               compression=archive_config.get("compression", "zstd"),
+                                               grace_period=archive_config.get("grace_period", 3600),
+                                               check_interval=archive_config.get("check_interval", 3600))
+            async_tasks.append(parquet_archiver.run())
+            stop_functions.append(parquet_archiver.stop)
+
     if "notifications" in config:
         webhook_endpoint = f"{config['notifications']['host']}/{config['notifications']['topic']}"
         icon_url = config["notifications"]["icon_url"]
@@ -59,6 +129,11 @@ def attach_observers(devices: dict[str, Device], config: dict):
     return async_tasks, stop_functions
 
 
-def attach_csv_file_logging_observer(device: Device, device_id: str, config: dict):
-    device.attach_observer(CsvFileLoggingObserver(config["csv_data_logging"]["base_filepath"], device_id,
-                                                  config["csv_data_logging"]["lines_per_file"]))
+def attach_csv_file_logging_observer(device: Device, device_id: str, config: dict) -> CsvFileLoggingObserver:
+    csv_observer = CsvFileLoggingObserver(config["csv_data_logging"]["base_filepath"], device_id,
+                                          config["csv_data_logging"]["lines_per_file"],
+                                          config["csv_data_logging"].get("flush_rows", 100),
+                                          config["csv_data_logging"].get("flush_interval", 5.0),
+                                          config["csv_data_logging"].get("compression"))
+    device.attach_observer(csv_observer)
+    return csv_observer
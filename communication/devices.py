@@ -7,6 +7,7 @@ import asyncio
 from enum import Enum
 
 from communication.observers import DeviceObserver
+from data_management.ring_buffer import DeviceRingBuffer
 
 
 class DeviceType(Enum):
@@ -57,6 +58,9 @@ class Device(abc.ABC):
     device_type: DeviceType = DeviceType.UNSPECIFIED
     device_id: str
 
+    # Recent samples kept in memory, so the dashboard doesn't need the database for them
+    history: DeviceRingBuffer = None
+
     def __init__(self, device_id: str):
         self.device_id = device_id
         self.log = logging.getLogger(self.device_id)
@@ -109,6 +113,10 @@ class Device(abc.ABC):
     async def receive_loop(self) -> None:
         while self.running:
             await self.receive()
+            if self.history is not None:
+                state_dictionary = self.get_state_dictionary()
+                if state_dictionary is not None:
+                    self.history.append(state_dictionary)
             await self.notify_observers()
 
     async def run(self) -> None:
@@ -1,19 +1,33 @@
 import abc
 import csv
-import datetime
 import os
 import asyncio
 import logging
+import time
 from abc import ABC
 
 import websockets
 import json
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy import Table, String, Column, Integer, Float, MetaData, insert, event, text
-from sqlalchemy.schema import CreateTable
-from data_management import sql_utilities
+from sqlalchemy import Table, String, Column, Integer, BigInteger, Float, text, inspect
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.schema import CreateTable, CreateIndex, DDL, ExecutableDDLElement
+from data_management import sql_utilities, csv_utilities
+from data_management.rollups import TieredRollup
+from data_management.ingest_compression import IngestCompressor, check_compression_settings
+from data_management import partitions
+from data_management import compact_arrays
+from data_management.schema_catalog import SchemaCatalog
+from data_management.spool import WriteAheadSpool
+from collections import deque
 import aiohttp
 
+# asyncpg raises its own errors when it can't connect, which SQLAlchemy doesn't wrap
+try:
+    from asyncpg.exceptions import PostgresConnectionError
+except ImportError:
+    PostgresConnectionError = None
+
 log = logging.getLogger("Observers")
 
 
@@ -29,30 +43,75 @@ class PrintObserver(DeviceObserver):
 
 
 class CsvFileLoggingObserver(DeviceObserver):
-    def __init__(self, base_filepath: str, device_id: str, lines_per_file: int):
+    # Rows are buffered and written out in batches from a thread, so a slow SD card never holds up the event loop.
+    # Finished files are optionally compressed, and their time ranges go into an index that the CSV data interface
+    # uses to find the files a window needs
+    def __init__(self, base_filepath: str, device_id: str, lines_per_file: int, flush_rows: int = 100,
+                 flush_interval: float = 5.0, compression: str = None):
         self.base_filepath = base_filepath
         self.device_id = device_id
         log.info(f"Creating CSV observer for device '{device_id}' with base file path '{base_filepath}'...")
         self.lines_per_file = lines_per_file
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.compression = csv_utilities.get_compression(compression)
 
         self.current_file = None
+        self.current_path = None
         self.csv_writer = None
+        self.current_headers = None
         self.current_line_count = 0
+        self.first_time = None
+        self.last_time = None
+        self.pending_rows = []
+        self.last_flush = time.monotonic()
+        # Stopping can come in while an update is still writing, and only one thread can have the file at a time
+        self.write_lock = asyncio.Lock()
+
+    def open_new_file(self, file_headers: list[str], timestamp: float):
+        self.close_current_file()
+
+        os.makedirs(self.base_filepath, exist_ok=True)
+        self.current_path = csv_utilities.get_new_path(self.base_filepath, self.device_id, timestamp)
+        self.current_file = open(self.current_path, 'x', newline="")
+        self.csv_writer = csv.writer(self.current_file)
+        self.csv_writer.writerow(file_headers)
+        self.current_headers = file_headers
+        self.current_line_count = 0
+        self.first_time = timestamp
 
-        os.makedirs(base_filepath, exist_ok=True)
-
-    def get_filename(self) -> str:
-        current_datetime = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-        filename = f"{current_datetime}_{self.device_id}.csv"
-        return os.path.join(self.base_filepath, filename)
-
-    def open_new_file(self, file_headers):
-        if self.current_file:
-            self.current_file.close()
+    def close_current_file(self):
+        if self.current_file is None:
+            return
 
-        self.current_file = open(self.get_filename(), 'w')
-        self.csv_writer = csv.DictWriter(self.current_file, fieldnames=file_headers)
-        self.csv_writer.writeheader()
+        self.current_file.close()
+        self.current_file = None
+        path = self.current_path
+        if self.compression is not None:
+            path = csv_utilities.compress_file(path, self.compression)
+        csv_utilities.append_index_entry(self.base_filepath, self.device_id, os.path.basename(path), self.first_time,
+                                         self.last_time)
+
+    def write_rows(self, rows: list[dict]):
+        # Runs in a thread. A file is finished once it's full or the device starts reporting different fields
+        for row in rows:
+            headers = list(row.keys())
+            if self.current_file is None or self.current_line_count >= self.lines_per_file or \
+                    headers != self.current_headers:
+                self.open_new_file(headers, row["time_updated"])
+
+            self.csv_writer.writerow(row.values())
+            self.current_line_count += 1
+            self.last_time = row["time_updated"]
+
+        self.current_file.flush()
+
+    async def flush(self):
+        rows, self.pending_rows = self.pending_rows, []
+        self.last_flush = time.monotonic()
+        if rows:
+            async with self.write_lock:
+                await asyncio.to_thread(self.write_rows, rows)
 
     async def update(self, device):
         device_state = device.get_state_dictionary()
@@ -60,17 +119,14 @@ class CsvFileLoggingObserver(DeviceObserver):
         if not device_state:
             return
 
-        if self.current_file is None or self.current_line_count >= self.lines_per_file:
-            headers = device_state.keys()
-            self.open_new_file(headers)
-            self.current_line_count = 0
+        self.pending_rows.append(device_state)
+        if len(self.pending_rows) >= self.flush_rows or time.monotonic() - self.last_flush >= self.flush_interval:
+            await self.flush()
 
-        self.csv_writer.writerow(device_state)
-        self.current_line_count += 1
-
-    def __del__(self):
-        if self.current_file is not None:
-            self.current_file.close()
+    async def stop(self):
+        await self.flush()
+        async with self.write_lock:
+            await asyncio.to_thread(self.close_current_file)
 
 
 class WebsocketServer:
@@ -128,54 +184,370 @@ class WebsocketObserver(DeviceObserver):
         await self.message_queue.put(message)
 
 
+class TablesNotCreated(Exception):
+    pass
+
+
 class SQLSession:
-    def __init__(self, sql_connection_string: str, shared_queue: asyncio.Queue):
-        self.engine = create_async_engine(sql_connection_string)
-        self.metadata = MetaData()
+    INGEST_MODES = ("insert", "copy")
+    # What we see when the database is down or the network to it is, as opposed to something wrong with a statement
+    CONNECTION_ERRORS = (OSError, asyncio.TimeoutError) + \
+        ((PostgresConnectionError,) if PostgresConnectionError is not None else ())
+
+    def __init__(self, sql_connection_string: str, shared_queue: asyncio.Queue, *, batch_size: int = 500,
+                 flush_interval: float = 1.0, ingest_mode: str = "insert", epoch_millisecond_keys: bool = False,
+                 sqlite_profile: dict = None, table_names: list[str] = None, pool_settings: dict = None,
+                 spool_settings: dict = None):
+        self.engine = sql_utilities.get_engine(sql_connection_string, pool_settings, sqlite_profile)
+        self.catalog = SchemaCatalog.for_connection_string(sql_connection_string)
+        self.metadata = self.catalog.metadata
+        self.table_names = table_names or []
         self.running = True
         self.statement_queue = shared_queue
         self.ready = [False]
-
-        # This is quite janky, but let's see if it works
-        if "sqlite" in sql_connection_string:
-            @event.listens_for(self.engine.sync_engine, "connect")
-            def set_sqlite_pragma(dbapi_connection, connection_record):
-                cursor = dbapi_connection.cursor()
-                cursor.execute("PRAGMA journal_mode=WAL")
-                cursor.close()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.insert_statements = sql_utilities.StatementCache()
+
+        if ingest_mode not in self.INGEST_MODES:
+            raise ValueError(f"Unknown ingest mode '{ingest_mode}', expected one of {self.INGEST_MODES}")
+        if ingest_mode == "copy" and self.engine.dialect.driver != "asyncpg":
+            log.warning("COPY ingest is only available with postgresql+asyncpg, falling back to inserts...")
+            ingest_mode = "insert"
+        self.ingest_mode = ingest_mode
+        self.epoch_millisecond_keys = epoch_millisecond_keys
+
+        spool_settings = spool_settings or {}
+        self.retry_interval = spool_settings.get("retry_interval", 10)
+        self.replay_batch_size = spool_settings.get("replay_batch_size", 5000)
+        self.spool = None
+        if "directory" in spool_settings:
+            self.spool = WriteAheadSpool(spool_settings["directory"],
+                                         int(spool_settings.get("segment_mb", 16) * 1024 * 1024),
+                                         spool_settings.get("fsync_interval", 1.0))
+        # While the database is down, rows go to the spool and statements wait here, since they're few and rows can
+        # depend on them
+        self.unreachable_since = None
+        self.last_attempt = 0.0
+        self.pending_statements = []
+        self.replay_task = None
 
     async def run_session(self):
         log.info(f"Starting SQL session with engine '{self.engine.name}'...")
-        async with self.engine.begin() as connection:
-            await connection.run_sync(self.metadata.create_all)
-            await connection.run_sync(self.metadata.reflect, views=True)
+        if self.spool is None:
+            await self.connect()
+        else:
+            await self.spool_until_connected()
 
-            self.ready[0] = True
+        if self.spool is not None and self.spool.has_records():
+            self.start_replay()
+
+        while self.running:
+            batch = await self.collect_batch()
+            if batch:
+                await self.write_or_spool(batch)
+
+        if self.spool is not None:
+            await asyncio.to_thread(self.spool.close_segment)
 
+    async def connect(self):
+        # The schema has to be loaded before the observers can decide what to create, so until the database is there
+        # they hold on to their samples and we keep trying
         while self.running:
-            statement = await self.statement_queue.get()
-            if statement is None:
+            try:
+                async with self.engine.begin() as connection:
+                    await self.catalog.load(connection, self.table_names)
+                    await connection.run_sync(sql_utilities.migrate_time_columns, self.metadata,
+                                              self.epoch_millisecond_keys)
+            except Exception as e:
+                if not self.is_unreachable(e):
+                    raise
+                log.warning(f"Can't reach the database ({e}), trying again in {self.retry_interval} seconds...")
+                await asyncio.sleep(self.retry_interval)
                 continue
-            async with self.engine.begin() as connection:
-                await connection.execute(statement)
+
+            self.ready[0] = True
+            return
+
+    async def spool_until_connected(self):
+        # With a spool, the observers don't wait for us, so whatever they send before the schema is loaded goes
+        # straight to it. That way nothing is lost however long the database is away when the daemon starts
+        connecting = asyncio.ensure_future(self.connect())
+        while not connecting.done():
+            getting = asyncio.ensure_future(self.statement_queue.get())
+            await asyncio.wait([connecting, getting], return_when=asyncio.FIRST_COMPLETED)
+            if not getting.done():
+                getting.cancel()
+                break
+
+            items = [getting.result()]
+            while not self.statement_queue.empty():
+                items.append(self.statement_queue.get_nowait())
+            await asyncio.to_thread(self.spool.append, [item for item in items if isinstance(item, tuple)])
+
+        await connecting
+
+    def is_unreachable(self, error: Exception) -> bool:
+        # Only a lost or refused connection counts. A missing table, a locked SQLite database and a statement timeout
+        # are all OperationalErrors too, and spooling those would just hide them
+        if isinstance(error, DBAPIError):
+            return error.connection_invalidated or isinstance(error.orig, self.CONNECTION_ERRORS)
+
+        return isinstance(error, self.CONNECTION_ERRORS)
+
+    async def write_or_spool(self, batch: list):
+        if self.spool is None:
+            await self.write_batch(batch)
+            return
+
+        # Once the database has gone away, we only try it again every so often rather than with every batch
+        if self.unreachable_since is None or time.monotonic() - self.last_attempt >= self.retry_interval:
+            self.last_attempt = time.monotonic()
+            try:
+                await self.write_batch(self.pending_statements + batch)
+            except Exception as e:
+                if not self.is_unreachable(e):
+                    await self.write_refused_batch(self.pending_statements + batch, e)
+                    return
+                self.mark_unreachable(e)
+            else:
+                self.pending_statements = []
+                if self.unreachable_since is not None:
+                    log.info(f"Database is back after {time.monotonic() - self.unreachable_since:.0f} seconds, "
+                             f"replaying the spool...")
+                    self.unreachable_since = None
+                    self.start_replay()
+                return
+
+        self.pending_statements += [item for item in batch if not isinstance(item, tuple)]
+        await asyncio.to_thread(self.spool.append, [item for item in batch if isinstance(item, tuple)])
+
+    def mark_unreachable(self, error: Exception):
+        if self.unreachable_since is None:
+            log.warning(f"Can't reach the database ({error}), spooling rows to '{self.spool.directory}'...")
+            self.unreachable_since = time.monotonic()
+
+    async def write_refused_batch(self, batch: list, error: Exception):
+        # The database is there, but something in the batch was refused, so the whole transaction was rolled back.
+        # The rows go to the spool, where replay sorts out any that can never be written, and each statement is tried
+        # again on its own. One that fails again is dropped, since trying it forever won't help
+        log.error(f"Writing a batch failed ({error}), spooling its rows and retrying its statements...")
+        self.unreachable_since = None
+        await asyncio.to_thread(self.spool.append, [item for item in batch if isinstance(item, tuple)])
+
+        statements = [item for item in batch if not isinstance(item, tuple)]
+        for i, statement in enumerate(statements):
+            try:
+                await self.write_batch([statement])
+            except Exception as e:
+                if self.is_unreachable(e):
+                    self.pending_statements = statements[i:]
+                    self.mark_unreachable(e)
+                    return
+                log.error(f"Dropping a statement that the database refused ({e})")
+
+        self.pending_statements = []
+        self.start_replay()
+
+    def start_replay(self):
+        if self.replay_task is None or self.replay_task.done():
+            self.replay_task = asyncio.ensure_future(self.replay_spool())
+
+    async def replay_spool(self):
+        # Runs alongside the live batches, oldest segment first, in much bigger transactions than the live ones. Each
+        # transaction commits before the spool records how far it got, so nothing is replayed twice
+        while self.running and self.unreachable_since is None:
+            segment = await asyncio.to_thread(self.spool.get_oldest_closed_segment)
+            if segment is None:
+                return
+
+            batches = self.spool.read_segment(segment, self.replay_batch_size)
+            try:
+                while (next_batch := await asyncio.to_thread(next, batches, None)) is not None:
+                    records, offset = next_batch
+                    await self.replay_records(records)
+                    await asyncio.to_thread(self.spool.mark_replayed, segment, offset)
+            except Exception as e:
+                # Either the database went away again, or one of our devices' tables hasn't been created yet in this
+                # run. Either way the rows stay spooled and we come back to them
+                log.warning(f"Replaying spool segment '{segment}' failed ({e}), trying again in "
+                            f"{self.retry_interval} seconds...")
+                batches.close()
+                await asyncio.sleep(self.retry_interval)
+                continue
+
+            await asyncio.to_thread(self.spool.remove_segment, segment)
+
+    async def replay_records(self, records: list[tuple[str, dict]]):
+        # Rows that the database refuses for good (say the device has gone, or its columns changed when the compact
+        # layout was switched) go to the dead letters, rather than holding up everything spooled after them
+        missing_tables = await self.get_missing_tables({table_name for table_name, _ in records})
+        if missing_tables & set(self.table_names):
+            raise TablesNotCreated(f"Waiting for {sorted(missing_tables & set(self.table_names))} to be created")
+
+        dead_letters = [record for record in records if record[0] in missing_tables]
+        records = [record for record in records if record[0] not in missing_tables]
+        error = f"no table {sorted(missing_tables)}" if missing_tables else None
+        try:
+            await self.write_batch(records)
+        except Exception as e:
+            if self.is_unreachable(e):
+                raise
+
+            # Something in the batch was refused, so it's written a row at a time to find out what
+            for record in records:
+                try:
+                    await self.write_batch([record])
+                except Exception as record_error:
+                    if self.is_unreachable(record_error):
+                        raise
+                    dead_letters.append(record)
+                    error = record_error
+
+        if dead_letters:
+            log.error(f"Moving {len(dead_letters)} spooled rows that the database refused to the dead letters "
+                      f"({error})")
+            await asyncio.to_thread(self.spool.add_dead_letters, dead_letters)
+
+    async def get_missing_tables(self, table_names: set[str]) -> set[str]:
+        async with self.engine.connect() as connection:
+            # Tables of devices that have since been taken out of the config still take their rows
+            await self.catalog.load(connection, list(table_names))
+            return await connection.run_sync(lambda sync_connection: {
+                table_name for table_name in table_names if not inspect(sync_connection).has_table(table_name)})
+
+    async def collect_batch(self) -> list:
+        # Items on the queue are either executable statements (DDL etc.) or (table name, row) tuples. We wait for the
+        # first item, then keep draining until we have enough rows or the flush interval has passed
+        batch = []
+        num_rows = 0
+        deadline = None
+
+        while num_rows < self.batch_size:
+            if deadline is None:
+                item = await self.statement_queue.get()
+                deadline = time.monotonic() + self.flush_interval
+            else:
+                remaining_time = deadline - time.monotonic()
+                if remaining_time <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.statement_queue.get(), remaining_time)
+                except asyncio.TimeoutError:
+                    break
+
+            if item is None:
+                break
+
+            batch.append(item)
+            if isinstance(item, tuple):
+                num_rows += 1
+
+        return batch
+
+    async def write_batch(self, batch: list):
+        # Everything in the batch is committed in a single transaction. Rows are grouped per table so that each group
+        # goes out as one executemany, and statements are run in queue order so tables exist before rows arrive
+        ddl_statements = []
+        async with self.engine.begin() as connection:
+            pending_rows = {}
+            for item in batch:
+                if isinstance(item, tuple):
+                    table_name, row = item
+                    pending_rows.setdefault((table_name, tuple(row.keys())), []).append(row)
+                else:
+                    await self.insert_rows(connection, pending_rows)
+                    pending_rows = {}
+                    await connection.execute(item)
+                    if isinstance(item, ExecutableDDLElement):
+                        ddl_statements.append(item)
+
+            await self.insert_rows(connection, pending_rows)
+
+        # Only once it's committed, so that nothing goes looking for a table before it's really there. The outage
+        # updates are statements too, but they don't change the schema, so they leave the cached queries alone
+        if ddl_statements:
+            self.catalog.record_ddl([statement.element.name for statement in ddl_statements if
+                                     isinstance(statement, CreateTable)])
+
+    async def insert_rows(self, connection, pending_rows: dict):
+        if self.ingest_mode == "copy":
+            await self.copy_rows(connection, pending_rows)
+            return
+
+        for (table_name, column_keys), rows in pending_rows.items():
+            insert_sql, parameter_order = self.insert_statements.get(
+                (table_name, column_keys),
+                lambda: sql_utilities.compile_insert(self.metadata.tables[table_name], list(column_keys),
+                                                     self.engine.dialect))
+            parameters = sql_utilities.get_insert_parameters(rows, parameter_order, self.engine.dialect)
+            await connection.exec_driver_sql(insert_sql, parameters)
+
+    async def copy_rows(self, connection, pending_rows: dict):
+        # Streams the rows straight into the tables with asyncpg's binary COPY protocol, bypassing INSERT entirely
+        raw_connection = await connection.get_raw_connection()
+        asyncpg_connection = raw_connection.driver_connection
+
+        for (table_name, column_keys), rows in pending_rows.items():
+            records = [tuple(row[key] for key in column_keys) for row in rows]
+            await asyncpg_connection.copy_records_to_table(table_name, records=records, columns=list(column_keys))
 
     async def stop(self):
         self.running = False
+        if self.replay_task is not None:
+            self.replay_task.cancel()
         self.statement_queue.put_nowait(None)
 
 
 class SQLDatabaseObserver(DeviceObserver):
-    def __init__(self, device_id: str, shared_queue: asyncio.Queue, sql_metadata: MetaData, ready: list[bool]):
+    # Without a spool, enough to cover the SQL session starting up without losing samples, without letting memory grow
+    # unbounded
+    MAX_PENDING_STATES = 3600
+
+    def __init__(self, device_id: str, shared_queue: asyncio.Queue, catalog: SchemaCatalog, ready: list[bool], *,
+                 dialect_name: str = None, epoch_millisecond_keys: bool = False, rollup_tiers: list[int] = None,
+                 partition_interval: str = None, compact_arrays: bool = False, ingest_compression: dict = None,
+                 spool_before_ready: bool = False, engine: AsyncEngine = None):
         self.device_id = device_id
         self.table_name = sql_utilities.get_table_name(device_id)
         self.summary_name = sql_utilities.get_summary_name(device_id)
         self.view_name = sql_utilities.get_view_name(device_id)
         self.statement_queue = shared_queue
-        self.metadata = sql_metadata
+        self.catalog = catalog
+        self.metadata = catalog.metadata
+        self.pending_states = deque(maxlen=self.MAX_PENDING_STATES)
+        # When the session has a spool, rows are sent before it's ready and it spools them, so none are dropped
+        self.spool_before_ready = spool_before_ready
         self.table_exists = False
         self.summary_exists = False
         self.view_exists = False
         self.ready = ready
+        self.dialect_name = dialect_name
+        self.epoch_millisecond_keys = epoch_millisecond_keys
+        self.rollups = TieredRollup(rollup_tiers) if rollup_tiers else None
+        self.rollup_names = {bucket_seconds: sql_utilities.get_rollup_name(device_id, bucket_seconds) for
+                             bucket_seconds in rollup_tiers or []}
+        self.rollups_exist = set()
+        # The rollups don't take any samples until their open buckets have been seeded from the database, which needs
+        # the session to be ready
+        self.engine = engine
+        self.rollups_seeded = False
+        self.unseeded_states = deque(maxlen=self.MAX_PENDING_STATES)
+        self.last_rollup_labels = {}
+        # Native range partitioning is a Postgres feature, elsewhere the raw table is a plain table
+        if partition_interval and dialect_name != "postgresql":
+            log.warning(f"Partitioning is only supported on Postgres, '{self.table_name}' will not be partitioned")
+            partition_interval = None
+        self.partition_interval = partition_interval
+        self.compact_arrays = compact_arrays
+        self.compressor = None
+        if ingest_compression is not None:
+            check_compression_settings(ingest_compression, rollup_tiers)
+            self.compressor = IngestCompressor(ingest_compression.get("method", "deadband"),
+                                               ingest_compression.get("tolerances"),
+                                               ingest_compression.get("default_tolerance", 0.0),
+                                               ingest_compression.get("heartbeat", 60),
+                                               ingest_compression.get("min_interval", 0))
 
     async def update(self, device):
         # TODO Need to think about if I add additional columns
@@ -183,65 +555,290 @@ class SQLDatabaseObserver(DeviceObserver):
 
         if device_state is None:
             log.warning(f"Device {self.device_id} did not fill its state dictionary")
+            return
+
+        # We need to wait until the SQL session has loaded the schema before we can create anything, so without a
+        # spool we hold on to the samples until then
+        if not self.ready[0] and not self.spool_before_ready:
+            self.pending_states.append(device_state)
+            return
+
+        while self.pending_states:
+            await self.store(self.pending_states.popleft())
+        await self.store(device_state)
+
+    async def store(self, device_state: dict):
+        # Compression decides which samples make it into the raw table, going by the values the device reported, so it
+        # comes before they're packed. The rollups still see every sample
+        stored_states = self.compressor.add(device_state) if self.compressor is not None else [device_state]
+
+        # Only what's stored is compacted, everything else in the daemon still sees the per-cell keys
+        if self.compact_arrays:
+            device_state = compact_arrays.compact_row(device_state, self.dialect_name)
+            stored_states = [compact_arrays.compact_row(state, self.dialect_name) for state in stored_states]
+
+        if self.ready[0]:
+            await self.create_missing_tables(device_state)
+
+        for stored_state in stored_states:
+            await self.statement_queue.put((self.table_name, self.with_time_key(stored_state)))
+
+        if self.rollups is not None:
+            await self.add_to_rollups(device_state)
 
-        # We need to wait until the SQL session has been created before we can do anything
+    async def add_to_rollups(self, device_state: dict):
+        self.unseeded_states.append(device_state)
         if not self.ready[0]:
             return
 
-        table_names = self.metadata.tables.keys()
+        if not self.rollups_seeded:
+            await self.seed_rollups(self.unseeded_states[0]["time_updated"])
+            self.rollups_seeded = True
+
+        while self.unseeded_states:
+            for bucket_seconds, rollup_row in self.rollups.add(self.unseeded_states.popleft()):
+                await self.put_rollup_row(bucket_seconds, rollup_row)
+
+    async def put_rollup_row(self, bucket_seconds: int, rollup_row: dict):
+        # A bucket that the tier already has a row for was finished before a restart
+        last_label = self.last_rollup_labels.get(bucket_seconds)
+        if last_label is not None and rollup_row["time_updated"] <= last_label:
+            return
+
+        await self.statement_queue.put((self.rollup_names[bucket_seconds], self.with_time_key(rollup_row)))
+
+    async def seed_rollups(self, first_timestamp: float):
+        # The buckets that were still open when the daemon last stopped only ever existed in memory, so they're rebuilt
+        # from the raw rows before the first new sample, along with any that closed while it was down. That way
+        # nothing has to be saved on the way out, and a crash loses nothing either. With ingest compression, the raw
+        # rows are only the samples that were kept, so the seeded part of a bucket is as close as it can get
+        if self.engine is None:
+            return
+
+        try:
+            async with self.engine.connect() as connection:
+                # Tables that are only just being created are in the catalog already, so we ask the database itself
+                table_names = [self.table_name, *self.rollup_names.values()]
+                existing_tables = await connection.run_sync(lambda sync_connection: {
+                    table_name for table_name in table_names if inspect(sync_connection).has_table(table_name)})
+                if self.table_name not in existing_tables:
+                    return
+
+                for rollup in self.rollups.rollups:
+                    rollup_name = self.rollup_names[rollup.bucket_seconds]
+                    if rollup_name in existing_tables:
+                        self.last_rollup_labels[rollup.bucket_seconds] = (await connection.execute(
+                            text(f"SELECT max(time_updated) FROM {rollup_name}"))).scalar()
+
+                # Far enough back for every tier's open bucket, and for the buckets after each tier's last row, but
+                # never more than a bucket of the coarsest tier before its open one
+                bucket_starts = []
+                for rollup in self.rollups.rollups:
+                    bucket_start = rollup.get_bucket_end(first_timestamp) - rollup.bucket_seconds
+                    last_label = self.last_rollup_labels.get(rollup.bucket_seconds)
+                    bucket_starts.append(min(bucket_start, last_label) if last_label is not None else bucket_start)
+                seed_start = max(min(bucket_starts), bucket_starts[-1] - self.rollups.rollups[-1].bucket_seconds)
+
+                columns = [column.name for column in self.metadata.tables[self.table_name].columns if
+                           column.name not in ("id", "time_key")]
+                result = await connection.stream(
+                    text(f"SELECT {', '.join(columns)} FROM {self.table_name} WHERE time_updated > :seed_start "
+                         f"AND time_updated < :first_timestamp ORDER BY time_updated"),
+                    {"seed_start": seed_start, "first_timestamp": first_timestamp})
+
+                num_rows = 0
+                async for rows in result.mappings().partitions(1000):
+                    for row in rows:
+                        # Buckets that started before the seeding did are missing their beginning
+                        for bucket_seconds, rollup_row in self.rollups.add(dict(row)):
+                            if rollup_row["time_updated"] - bucket_seconds >= seed_start:
+                                await self.put_rollup_row(bucket_seconds, rollup_row)
+                    num_rows += len(rows)
+        except Exception as e:
+            log.error(f"Failed to seed the rollups of '{self.device_id}' from the database, their open buckets will "
+                      f"only have the samples from now on: {e}")
+            self.rollups = TieredRollup(list(self.rollup_names))
+            return
+
+        log.info(f"Seeded the open rollup buckets of '{self.device_id}' from {num_rows} raw rows")
+
+    async def create_missing_tables(self, device_state: dict):
         if not self.table_exists:
-            self.table_exists = self.table_name in table_names
+            self.table_exists = self.catalog.has_table(self.table_name)
 
             if not self.table_exists:
                 log.info(f"Creating new table '{self.table_name}' in database...")
-                await self.statement_queue.put(self.new_table_expression(self.table_name, device_state))
+                partitioned = self.partition_interval is not None
+                await self.statement_queue.put(self.new_table_expression(self.table_name, device_state,
+                                                                             partitioned=partitioned))
+                if self.partition_interval:
+                    [await self.statement_queue.put(expression) for expression in
+                     partitions.new_partition_expressions(self.table_name, device_state["time_updated"],
+                                                          self.partition_interval)]
+                [await self.statement_queue.put(expression) for expression in
+                 self.new_index_expressions(self.table_name)]
+                self.table_exists = True
 
         if not self.summary_exists:
-            self.summary_exists = self.summary_name in table_names
+            self.summary_exists = self.catalog.has_table(self.summary_name)
 
             if not self.summary_exists:
                 log.info(f"Creating new summary table '{self.summary_name}' in database...")
                 await self.statement_queue.put(self.new_table_expression(self.summary_name, device_state, True))
+                [await self.statement_queue.put(expression) for expression in
+                 self.new_index_expressions(self.summary_name)]
+                self.summary_exists = True
+
+        for rollup_name in self.rollup_names.values():
+            if rollup_name == self.summary_name or rollup_name in self.rollups_exist:
+                continue
+
+            if not self.catalog.has_table(rollup_name):
+                log.info(f"Creating new rollup table '{rollup_name}' in database...")
+                await self.statement_queue.put(self.new_table_expression(rollup_name, device_state, True))
+                [await self.statement_queue.put(expression) for expression in self.new_index_expressions(rollup_name)]
+            self.rollups_exist.add(rollup_name)
 
         if not self.view_exists:
-            self.view_exists = self.view_name in table_names
+            self.view_exists = self.catalog.has_table(self.view_name)
 
             if not self.view_exists:
                 log.info(f"Creating new view '{self.view_name}' in database...")
                 await self.statement_queue.put(self.new_view_expression(device_state))
+                # Views created from text never make it into the metadata, so we remember that we've created it
+                self.view_exists = True
+
+    def with_time_key(self, row: dict) -> dict:
+        if not self.epoch_millisecond_keys:
+            return row
 
-        table = self.metadata.tables[self.table_name]
-        insert_statement = insert(table).values(device_state)
-        await self.statement_queue.put(insert_statement)
+        return {**row, "time_key": sql_utilities.get_time_key(row["time_updated"])}
 
-    def new_table_expression(self, table_name, state_dictionary, add_standard_deviation_columns: bool = False):
+    def new_table_expression(self, table_name, state_dictionary, add_standard_deviation_columns: bool = False,
+                             partitioned: bool = False):
         type_mapping = {
             str: String,
             int: Integer,
             float: Float,
+            # Packed arrays, from the compact layout
+            bytes: compact_arrays.get_column_type(self.dialect_name),
+            list: compact_arrays.get_column_type(self.dialect_name),
         }
 
-        table = Table(table_name, self.metadata)
+        # A partitioned table's primary key has to include the partition key
+        if partitioned:
+            table = Table(table_name, self.metadata, postgresql_partition_by="RANGE (time_updated)")
+        else:
+            table = Table(table_name, self.metadata)
+        self.catalog.add_pending_table(table_name)
         table.append_column(Column("id", Integer, primary_key=True, autoincrement=True))
 
         for key, value in state_dictionary.items():
             column_python_type = type(value)
             column_type = type_mapping[column_python_type]
-            table.append_column(Column(key, column_type))
+            table.append_column(Column(key, column_type, primary_key=partitioned and key == "time_updated"))
 
             if add_standard_deviation_columns and column_python_type == float and key != "time_updated":
                 table.append_column(Column(f"{key}_stdev", column_type))
 
+        if self.epoch_millisecond_keys:
+            table.append_column(Column("time_key", BigInteger))
+
         create_expression = CreateTable(table)
         return create_expression
 
+    def new_index_expressions(self, table_name):
+        table = self.metadata.tables[table_name]
+        return [CreateIndex(index) for index in sql_utilities.time_indexes(table, self.dialect_name)]
+
     def new_view_expression(self, state_dictionary):
         view_columns = state_dictionary.keys()
         columns_sql = ", ".join(view_columns)
 
-        view_sql = (f"create view {self.view_name} as select {columns_sql} from {self.summary_name} "
+        # With streaming rollups the summary overlaps the raw data, so we only take the summary from before the raw data
+        summary_filter = ""
+        if self.rollups is not None:
+            summary_filter = (f" where time_updated < coalesce((select min(time_updated) from {self.table_name}), "
+                              f"9e18)")
+
+        view_sql = (f"create view {self.view_name} as select {columns_sql} from {self.summary_name}{summary_filter} "
                     f"union all select {columns_sql} from {self.table_name}")
-        return text(view_sql)
+        return DDL(view_sql)
+
+
+class GridOutageObserver(DeviceObserver):
+    # Writes each grid on/off transition to the device's outage table as it happens, so that questions about outages
+    # never have to scan the raw inverter data
+    MAX_PENDING_STATES = 3600
+
+    def __init__(self, device_id: str, shared_queue: asyncio.Queue, catalog: SchemaCatalog, ready: list[bool]):
+        self.device_id = device_id
+        self.outage_table_name = sql_utilities.get_outage_table_name(device_id)
+        self.view_name = sql_utilities.get_view_name(device_id)
+        self.statement_queue = shared_queue
+        self.catalog = catalog
+        self.ready = ready
+        self.pending_states = deque(maxlen=self.MAX_PENDING_STATES)
+        self.table_exists = False
+        # Unknown until the first sample, which might be in the middle of an outage that started before a restart
+        self.grid_on = None
+        self.last_on = None
+
+    async def update(self, device):
+        device_state = device.get_state_dictionary()
+        if device_state is None or "grid_state" not in device_state:
+            return
+
+        if not self.ready[0]:
+            self.pending_states.append(device_state)
+            return
+
+        while self.pending_states:
+            await self.record(self.pending_states.popleft())
+        await self.record(device_state)
+
+    async def record(self, device_state: dict):
+        if not self.table_exists:
+            self.table_exists = self.catalog.has_table(self.outage_table_name)
+
+            if not self.table_exists:
+                log.info(f"Creating new outage table '{self.outage_table_name}' in database...")
+                table = sql_utilities.new_outage_table(self.catalog.metadata, self.outage_table_name)
+                self.catalog.add_pending_table(self.outage_table_name)
+                await self.statement_queue.put(CreateTable(table))
+                [await self.statement_queue.put(CreateIndex(index)) for index in table.indexes]
+                self.table_exists = True
+
+        grid_on = device_state["grid_state"] == "on"
+        if grid_on and self.grid_on is not True:
+            await self.statement_queue.put(self.end_outage_expression(device_state["time_updated"]))
+        elif not grid_on and self.grid_on is not False:
+            await self.statement_queue.put(self.start_outage_expression(self.last_on, device_state["time_updated"]))
+
+        self.grid_on = grid_on
+        if grid_on:
+            self.last_on = device_state["time_updated"]
+
+    def start_outage_expression(self, last_on: float, started: float):
+        # Only opens an outage if there isn't one open already, which there will be if we restarted during it. If we
+        # haven't seen the grid on ourselves, we look for when it last was, which only ever happens the once
+        return text(f"insert into {self.outage_table_name} (last_on, started) select coalesce(:last_on, "
+                    f"(select max(time_updated) from {self.view_name} where grid_state = 'on')), :started "
+                    f"where not exists (select 1 from {self.outage_table_name} where ended is null)").bindparams(
+            last_on=last_on, started=started)
+
+    def end_outage_expression(self, ended: float):
+        return text(f"update {self.outage_table_name} set ended = :ended where ended is null").bindparams(
+            ended=ended)
+
+
+class ResultCacheObserver(DeviceObserver):
+    # Keeps cached query results in step with what the devices report, rather than waiting for them to expire
+    def __init__(self, result_cache):
+        self.result_cache = result_cache
+
+    async def update(self, device):
+        self.result_cache.add_sample(device.device_id, device.get_state_dictionary())
 
 
 class NotificationObserver(DeviceObserver, ABC):
@@ -0,0 +1,36 @@
+import bisect
+
+
+def asof_indices(times: list[float], other_times: list[float], tolerance: float = None) -> list[int]:
+    # For each time, the index of the latest of the other samples at or before it, or None if there isn't one (or if
+    # it's older than the tolerance). Both lists are in time order, so this is a single merge-like pass
+    indices = []
+    position = 0
+    for timestamp in times:
+        position = bisect.bisect_right(other_times, timestamp, position)
+        index = position - 1
+        if index < 0 or (tolerance is not None and timestamp - other_times[index] > tolerance):
+            indices.append(None)
+        else:
+            indices.append(index)
+
+    return indices
+
+
+def asof_join(base_key: str, base_result: dict, other_results: dict[str, dict], tolerance: float = None) -> dict:
+    # Lines the other devices' columns up against the base device's timestamps, each row taking the most recent
+    # earlier sample from every other device. Columns are named device_key.column, so nothing collides
+    if not base_result:
+        return {}
+
+    joined = {"time_updated": list(base_result["time_updated"])}
+    joined.update({f"{base_key}.{column}": list(values) for column, values in base_result.items()
+                   if column != "time_updated"})
+
+    for device_key, result in other_results.items():
+        indices = asof_indices(joined["time_updated"], result.get("time_updated", []), tolerance)
+        for column, values in result.items():
+            if column != "time_updated":
+                joined[f"{device_key}.{column}"] = [values[i] if i is not None else None for i in indices]
+
+    return joined
@@ -0,0 +1,296 @@
+import asyncio
+import logging
+import os
+from time import time
+from sqlalchemy import text, inspect, MetaData, Table
+from sqlalchemy.ext.asyncio import AsyncEngine
+from data_management import sql_utilities, partitions
+
+# Parquet needs pyarrow, which is a big install for a Raspberry Pi, so archiving is only available when it's there
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+log = logging.getLogger("Archive")
+
+ARCHIVE_TABLES = ("raw", "summary")
+ARCHIVE_SUFFIX = ".parquet"
+WATERMARK_FILENAME = "watermark"
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_GRACE_PERIOD = 3600  # seconds
+
+
+def check_pyarrow():
+    if pyarrow is None:
+        raise ValueError("Parquet archives need the pyarrow package")
+
+
+def get_archive_table_name(device_id: str, table: str) -> str:
+    if table not in ARCHIVE_TABLES:
+        raise ValueError(f"Unknown archive table '{table}', expected one of {ARCHIVE_TABLES}")
+
+    return sql_utilities.get_table_name(device_id) if table == "raw" else sql_utilities.get_summary_name(device_id)
+
+
+def get_archive_path(archive_directory: str, table_name: str, start, interval: str) -> str:
+    # Named like the Postgres partitions, e.g. archive/device_x/device_x_p20240131.parquet, so the bounds of a file
+    # can be read back from its name
+    return os.path.join(archive_directory, table_name,
+                        partitions.get_partition_name(table_name, start, interval) + ARCHIVE_SUFFIX)
+
+
+def get_archived_files(archive_directory: str, table_name: str, interval: str) -> list[tuple[str, float, float]]:
+    # Each archive file of a table with the (start, end) timestamps it covers, oldest first
+    table_directory = os.path.join(archive_directory, table_name)
+    if not os.path.isdir(table_directory):
+        return []
+
+    archived_files = []
+    for filename in sorted(os.listdir(table_directory)):
+        if not filename.endswith(ARCHIVE_SUFFIX):
+            continue
+
+        bounds = partitions.get_partition_bounds(filename[:-len(ARCHIVE_SUFFIX)], table_name, interval)
+        if bounds is not None:
+            archived_files.append((os.path.join(table_directory, filename), *bounds))
+
+    return archived_files
+
+
+def get_archived_row_count(path: str) -> int:
+    # Only the footer is read
+    if not os.path.exists(path):
+        return 0
+
+    return pyarrow.parquet.read_metadata(path).num_rows
+
+
+def read_watermark(archive_directory: str, table_name: str):
+    # (the highest id seen, and the start of the first period that wasn't finished) as of the last pass, or None
+    path = os.path.join(archive_directory, table_name, WATERMARK_FILENAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as watermark_file:
+        max_id, open_start = watermark_file.read().strip().split(",")
+    return int(max_id), float(open_start)
+
+
+def write_watermark(archive_directory: str, table_name: str, max_id: int, open_start: float):
+    table_directory = os.path.join(archive_directory, table_name)
+    os.makedirs(table_directory, exist_ok=True)
+    temporary_path = os.path.join(table_directory, WATERMARK_FILENAME + ".tmp")
+    with open(temporary_path, "w") as watermark_file:
+        watermark_file.write(f"{max_id},{open_start}")
+    os.replace(temporary_path, os.path.join(table_directory, WATERMARK_FILENAME))
+
+
+def get_arrow_type(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return pyarrow.string()
+
+    # Packed cell voltages and temperatures are float32 arrays on Postgres, and the packed bytes on SQLite
+    return {int: pyarrow.int64(), float: pyarrow.float64(), bool: pyarrow.bool_(), str: pyarrow.string(),
+            bytes: pyarrow.binary(), list: pyarrow.list_(pyarrow.float32())}.get(python_type, pyarrow.string())
+
+
+def read_archive(archive_directory: str, table_name: str, start_timestamp: float, end_timestamp: float,
+                 columns: list[str] = None, interval: str = "daily") -> dict:
+    # Only the files whose period overlaps the range are opened, only the asked-for columns are read from them, and
+    # the time filter skips every row group whose time statistics are outside the range
+    check_pyarrow()
+    paths = [path for path, start, end in get_archived_files(archive_directory, table_name, interval) if
+             start < end_timestamp and end > start_timestamp]
+    if not paths:
+        return {}
+
+    # Devices gain columns over time, so the files don't all have the same ones
+    schema = pyarrow.unify_schemas([pyarrow.parquet.read_schema(path) for path in paths])
+    selected_columns = None
+    if columns:
+        selected_columns = ["time_updated"] + [column for column in columns if column != "time_updated"]
+        for column in selected_columns:
+            if column not in schema.names:
+                raise ValueError(f"Unknown column '{column}' in the archive of '{table_name}'")
+
+    time_field = pyarrow.dataset.field("time_updated")
+    table = pyarrow.dataset.dataset(paths, schema=schema, format="parquet").to_table(
+        columns=selected_columns, filter=(time_field >= start_timestamp) & (time_field < end_timestamp))
+    if table.num_rows == 0:
+        return {}
+
+    return table.sort_by("time_updated").to_pydict()
+
+
+async def get_device_ids(engine: AsyncEngine) -> list[str]:
+    # Every device that has a raw table in the database, for archiving without a list of devices
+    prefix = sql_utilities.get_table_name("")
+    async with engine.connect() as connection:
+        table_names = await connection.run_sync(lambda sync_connection: inspect(sync_connection).get_table_names())
+
+    return sorted(table_name[len(prefix):] for table_name in table_names if table_name.startswith(prefix))
+
+
+class ParquetArchiver:
+    # Exports each closed day (or month) of the raw and summary tables to its own Parquet file, streaming the rows out
+    # of the database a chunk at a time. A period is closed once it ended more than the grace period ago, and once the
+    # summaries have caught up with it. Periods that are already in a file are left alone unless more of their rows
+    # have turned up since, so every pass only exports what's new, and deleting the rows afterwards is left to
+    # retention (which has to keep them for longer than an outage can last, for the late ones to make it in)
+    def __init__(self, engine: AsyncEngine, device_ids: list[str], *, archive_directory: str = "archive",
+                 interval: str = "daily", tables: list[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 compression: str = "zstd", grace_period: float = DEFAULT_GRACE_PERIOD, check_interval: int = 3600):
+        check_pyarrow()
+        if interval not in partitions.PARTITION_INTERVALS:
+            raise ValueError(f"Unknown archive interval '{interval}', expected one of "
+                             f"{partitions.PARTITION_INTERVALS}")
+
+        self.engine = engine
+        self.device_ids = device_ids
+        self.archive_directory = archive_directory
+        self.interval = interval
+        self.table_names = [get_archive_table_name(device_id, table) for device_id in device_ids for table in
+                            tables or ARCHIVE_TABLES]
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.grace_period = grace_period
+        self.check_interval = check_interval
+        self.running = True
+        self.stop_event = asyncio.Event()
+
+    async def run(self):
+        log.info(f"Starting archiving of {len(self.table_names)} tables to '{self.archive_directory}'...")
+        while self.running:
+            try:
+                await self.archive()
+            except Exception as e:
+                log.error(f"Failed to archive: {e}")
+
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def archive(self, until_timestamp: float = None) -> int:
+        # Returns the number of files written
+        until_timestamp = min(until_timestamp or time(), time() - self.grace_period)
+        num_written = 0
+        for table_name in self.table_names:
+            if not self.running:
+                break
+
+            table = await self.reflect_table(table_name)
+            if table is None:
+                continue
+
+            periods, watermark = await self.get_unarchived_periods(table_name, until_timestamp)
+            for start, end in periods:
+                if not self.running:
+                    break
+
+                path = get_archive_path(self.archive_directory, table_name, start, self.interval)
+                num_rows = await self.export_period(table, start.timestamp(), end.timestamp(), path)
+                num_written += 1
+                log.info(f"Archived {num_rows} rows of '{table_name}' to '{path}'")
+            else:
+                # Only once everything up to it is in the files
+                if watermark is not None:
+                    await asyncio.to_thread(write_watermark, self.archive_directory, table_name, *watermark)
+
+        return num_written
+
+    async def reflect_table(self, table_name: str):
+        def reflect(sync_connection):
+            if not self.engine.dialect.has_table(sync_connection, table_name):
+                return None
+            return Table(table_name, MetaData(), autoload_with=sync_connection)
+
+        async with self.engine.connect() as connection:
+            return await connection.run_sync(reflect)
+
+    async def get_unarchived_periods(self, table_name: str, until_timestamp: float) -> tuple[list[tuple], tuple]:
+        # Returns the periods to export, and the watermark to keep once they have been. Only the periods after the
+        # last pass's watermark are looked at, along with any that rows have turned up in since (found by their ids,
+        # which only ever go up), so a pass costs the same however much history there is
+        quoted_name = self.engine.dialect.identifier_preparer.quote(table_name)
+        count_query = text(f"SELECT count(*) FROM {quoted_name} WHERE time_updated >= :start_timestamp "
+                           f"AND time_updated < :end_timestamp")
+        watermark = await asyncio.to_thread(read_watermark, self.archive_directory, table_name)
+        async with self.engine.connect() as connection:
+            max_id, last_timestamp = (await connection.execute(
+                text(f"SELECT max(id), max(time_updated) FROM {quoted_name}"))).one()
+            if max_id is None:
+                return [], None
+
+            if watermark is None:
+                first_timestamp = (await connection.execute(
+                    text(f"SELECT min(time_updated) FROM {quoted_name}"))).scalar()
+            else:
+                last_max_id, first_timestamp = watermark
+                late_timestamp = (await connection.execute(
+                    text(f"SELECT min(time_updated) FROM {quoted_name} WHERE id > :max_id"),
+                    {"max_id": last_max_id})).scalar()
+                if late_timestamp is not None:
+                    first_timestamp = min(first_timestamp, late_timestamp)
+
+            # Unless they're streamed, summary rows only exist as far as summarising has got, so a period of the
+            # summary isn't finished until the summary has passed its end
+            if table_name.startswith(sql_utilities.get_summary_name("")):
+                until_timestamp = min(until_timestamp, last_timestamp)
+
+            # A period is exported again when the database has more of its rows than its file does, which is what
+            # rows replayed from the spool (or summaries written late) look like. Fewer rows means retention has been
+            # at it, and the file is left alone. Empty periods don't get a file, so they're only exported once
+            # something turns up in them
+            periods = []
+            start = partitions.get_partition_start(first_timestamp, self.interval)
+            while (end := partitions.get_next_partition_start(start, self.interval)).timestamp() <= until_timestamp:
+                num_rows = (await connection.execute(count_query, {"start_timestamp": start.timestamp(),
+                                                                   "end_timestamp": end.timestamp()})).scalar()
+                path = get_archive_path(self.archive_directory, table_name, start, self.interval)
+                if num_rows > await asyncio.to_thread(get_archived_row_count, path):
+                    periods.append((start, end))
+                start = end
+
+        return periods, (max_id, start.timestamp())
+
+    async def export_period(self, table: Table, start_timestamp: float, end_timestamp: float, path: str) -> int:
+        # Each chunk from the database becomes a row group. The rows come out in time order, so each row group covers
+        # its own stretch of time and reads of part of a period can skip the rest by their statistics
+        schema = pyarrow.schema([(column.name, get_arrow_type(column)) for column in table.columns])
+        quoted_name = self.engine.dialect.identifier_preparer.quote(table.name)
+        query = text(f"SELECT * FROM {quoted_name} WHERE time_updated >= :start_timestamp "
+                     f"AND time_updated < :end_timestamp ORDER BY time_updated")
+
+        # Written under a temporary name, so a file that exists is always complete
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = path + ".tmp"
+        writer = await asyncio.to_thread(pyarrow.parquet.ParquetWriter, temporary_path, schema,
+                                         compression=self.compression)
+        num_rows = 0
+        try:
+            async with self.engine.connect() as connection:
+                result = await connection.stream(query, {"start_timestamp": start_timestamp,
+                                                         "end_timestamp": end_timestamp})
+                keys = list(result.keys())
+                async for rows in result.partitions(self.chunk_size):
+                    chunk = pyarrow.Table.from_pydict(dict(zip(keys, map(list, zip(*rows)))), schema=schema)
+                    await asyncio.to_thread(writer.write_table, chunk)
+                    num_rows += len(rows)
+        except BaseException:
+            await asyncio.to_thread(writer.close)
+            os.remove(temporary_path)
+            raise
+
+        await asyncio.to_thread(writer.close)
+        os.replace(temporary_path, path)
+        return num_rows
+
+    async def stop(self):
+        self.running = False
+        self.stop_event.set()
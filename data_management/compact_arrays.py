@@ -0,0 +1,117 @@
+import re
+import sys
+from array import array
+from sqlalchemy import LargeBinary, REAL
+from sqlalchemy.dialects.postgresql import ARRAY
+
+# Each packed column and the prefix of the per-element keys that the devices report, e.g. voltage_cell_1..16
+ARRAY_COLUMNS = {
+    "cell_voltages": "voltage_cell_",
+    "temperatures": "temperature_",
+}
+
+ELEMENT_PATTERN = re.compile(rf"^({'|'.join(ARRAY_COLUMNS.values())})(\d+)$")
+
+
+def get_array_column(key: str):
+    # The packed column that a per-element key is stored in, or None if it isn't one
+    match = ELEMENT_PATTERN.match(key)
+    if match is None:
+        return None
+
+    return next(column for column, prefix in ARRAY_COLUMNS.items() if prefix == match.group(1))
+
+
+def get_column_type(dialect_name: str):
+    return ARRAY(REAL) if dialect_name == "postgresql" else LargeBinary
+
+
+def pack(values: list[float], dialect_name: str):
+    # float32 is plenty for millivolts and tenths of a degree, and half the size of the doubles they'd otherwise be
+    if dialect_name == "postgresql":
+        return [float(value) for value in values]
+
+    packed = array("f", values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+
+    return packed.tobytes()
+
+
+def unpack(value) -> list[float]:
+    if value is None:
+        return value
+
+    # Postgres hands real[] back as a list, and SQLite gives us the bytes we packed
+    unpacked = value
+    if isinstance(value, bytes):
+        unpacked = array("f")
+        unpacked.frombytes(value)
+        if sys.byteorder != "little":
+            unpacked.byteswap()
+
+    # Rounded back to what the devices report, rather than showing off float32's rounding errors
+    return [round(element, 4) for element in unpacked]
+
+
+def compact_row(state_dictionary: dict, dialect_name: str) -> dict:
+    # Swaps the per-element keys for one packed column each, plus the statistics that the dashboard and any range
+    # queries actually filter and chart on, so nobody has to unpack arrays to find the weakest cell
+    row = {}
+    elements = {}
+    for key, value in state_dictionary.items():
+        array_column = get_array_column(key)
+        if array_column is None:
+            row[key] = value
+        else:
+            elements.setdefault(array_column, []).append((int(ELEMENT_PATTERN.match(key).group(2)), value))
+
+    for array_column, numbered_values in elements.items():
+        values = [value for _, value in sorted(numbered_values)]
+        row[array_column] = pack(values, dialect_name)
+        row[f"{array_column}_min"] = float(min(values))
+        row[f"{array_column}_max"] = float(max(values))
+        row[f"{array_column}_spread"] = round(float(max(values) - min(values)), 6)
+
+    return row
+
+
+def get_stored_columns(columns: list[str] = None):
+    # Requests for single elements read the packed column they live in
+    if not columns:
+        return columns
+
+    stored_columns = []
+    for column in columns:
+        stored_column = get_array_column(column) or column
+        if stored_column not in stored_columns:
+            stored_columns.append(stored_column)
+
+    return stored_columns
+
+
+def expand_result(result: dict, columns: list[str] = None) -> dict:
+    # Unpacks each packed column of a column-wise result back into the per-element columns the devices report. Any
+    # suffix the query added (like _last) is carried over to the element columns. With explicit columns, only the
+    # elements that were asked for (or all of them, for the packed column itself) are kept, so the result lines up
+    # with ones read from the in-memory history
+    if not result:
+        return result
+
+    expanded_result = {}
+    for key, values in result.items():
+        array_column = next((column for column in ARRAY_COLUMNS if key == column or key.startswith(f"{column}_")),
+                            None)
+        # The statistics columns share the prefix, but they're plain numbers
+        if array_column is None or not any(isinstance(value, (bytes, list)) for value in values):
+            expanded_result[key] = values
+            continue
+
+        suffix = key[len(array_column):]
+        rows = [unpack(value) or [] for value in values]
+        for i in range(max((len(row) for row in rows), default=0)):
+            element_key = f"{ARRAY_COLUMNS[array_column]}{i + 1}{suffix}"
+            if not columns or element_key in columns or array_column in columns:
+                expanded_result[element_key] = [row[i] if i < len(row) else None for row in rows]
+
+    return expanded_result
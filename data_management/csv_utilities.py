@@ -0,0 +1,134 @@
+import csv
+import datetime
+import gzip
+import io
+import logging
+import os
+
+# zstd compresses logs better and faster than gzip, but it's an extra install, so it's only used when it's there
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+log = logging.getLogger("CSV utilities")
+
+COMPRESSION_SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+FILENAME_TIME_FORMAT = "%Y%m%d%H%M%S"
+
+
+def get_compression(compression: str = None):
+    if compression is not None and compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression '{compression}', expected one of {list(COMPRESSION_SUFFIXES)}")
+
+    if compression == "zstd" and zstandard is None:
+        log.warning("zstd compression needs the zstandard package, falling back to gzip...")
+        return "gzip"
+
+    return compression
+
+
+def get_filename(device_id: str, timestamp: float) -> str:
+    return f"{datetime.datetime.fromtimestamp(timestamp).strftime(FILENAME_TIME_FORMAT)}_{device_id}.csv"
+
+
+def get_new_path(base_filepath: str, device_id: str, timestamp: float) -> str:
+    # The names only go down to the second, so a file opened in the same second as the last one (compressed or not)
+    # takes the next second that's free, which keeps the names unique and in order
+    while True:
+        path = os.path.join(base_filepath, get_filename(device_id, timestamp))
+        if not any(os.path.exists(path + suffix) for suffix in ["", *COMPRESSION_SUFFIXES.values()]):
+            return path
+        timestamp += 1
+
+
+def get_filename_timestamp(filename: str) -> float:
+    return datetime.datetime.strptime(filename.split("_", 1)[0], FILENAME_TIME_FORMAT).timestamp()
+
+
+def get_index_path(base_filepath: str, device_id: str) -> str:
+    return os.path.join(base_filepath, f"{device_id}.index")
+
+
+def get_device_files(base_filepath: str, device_id: str) -> list[str]:
+    # The names start with the time they were opened, so sorting them puts them in time order
+    suffixes = tuple(f".csv{suffix}" for suffix in ["", *COMPRESSION_SUFFIXES.values()])
+    if not os.path.isdir(base_filepath):
+        return []
+
+    filenames = {filename for filename in os.listdir(base_filepath) if
+                 filename.endswith(suffixes) and filename.split("_", 1)[-1].split(".csv")[0] == device_id}
+    # For a moment after a file is compressed, the original is still there too
+    return sorted(filename for filename in filenames if not
+                  any(filename + suffix in filenames for suffix in COMPRESSION_SUFFIXES.values()))
+
+
+def read_index(base_filepath: str, device_id: str) -> dict[str, tuple[float, float]]:
+    # Each finished file's first and last timestamps, by filename
+    index = {}
+    try:
+        with open(get_index_path(base_filepath, device_id), newline="") as index_file:
+            for filename, first_time, last_time in csv.reader(index_file):
+                index[filename] = (float(first_time), float(last_time))
+    except FileNotFoundError:
+        pass
+
+    return index
+
+
+def append_index_entry(base_filepath: str, device_id: str, filename: str, first_time: float, last_time: float):
+    with open(get_index_path(base_filepath, device_id), "a", newline="") as index_file:
+        csv.writer(index_file).writerow([filename, first_time, last_time])
+
+
+def compress_file(path: str, compression: str) -> str:
+    # Returns the path of the compressed file, which replaces the original. It's written under a temporary name, so
+    # a reader never comes across one that's only partly written
+    compressed_path = path + COMPRESSION_SUFFIXES[compression]
+    temporary_path = compressed_path + ".tmp"
+    with open(path, "rb") as source_file:
+        if compression == "zstd":
+            with open(temporary_path, "wb") as compressed_file:
+                zstandard.ZstdCompressor().copy_stream(source_file, compressed_file)
+        else:
+            with gzip.open(temporary_path, "wb") as compressed_file:
+                compressed_file.writelines(source_file)
+
+    os.replace(temporary_path, compressed_path)
+    os.remove(path)
+    return compressed_path
+
+
+def open_text(path: str):
+    # A file can be compressed between being listed and being opened, in which case it's read from the compressed one
+    if not os.path.exists(path):
+        path = next((path + suffix for suffix in COMPRESSION_SUFFIXES.values() if os.path.exists(path + suffix)), path)
+
+    if path.endswith(COMPRESSION_SUFFIXES["gzip"]):
+        return gzip.open(path, "rt", newline="")
+    if path.endswith(COMPRESSION_SUFFIXES["zstd"]):
+        if zstandard is None:
+            raise ValueError(f"Reading '{path}' needs the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True),
+                                newline="")
+
+    return open(path, newline="")
+
+
+def parse_value(value: str):
+    # Everything comes back from a CSV file as text, so numbers have to be recognised again
+    if value == "":
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        pass
+
+    try:
+        return float(value)
+    except ValueError:
+        return value
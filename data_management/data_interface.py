@@ -1,8 +1,18 @@
+import asyncio
+import csv
+import datetime
+import functools
+import math
+import os
 from enum import Enum
 from abc import ABC, abstractmethod
-from data_management import sql_utilities
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy import text, MetaData
+from data_management import sql_utilities, csv_utilities, partitions, retention, downsampling, alignment, \
+    compact_arrays, archive
+from data_management.ingest_compression import reconstruct_steps, check_compression_settings
+from data_management.rollups import BucketRollup, get_bucket_row
+from data_management.schema_catalog import SchemaCatalog
+from data_management.ring_buffer import DeviceRingBuffer
+from sqlalchemy import text, MetaData, insert
 from time import time
 
 
@@ -14,6 +24,17 @@ class DataStorageType(Enum):
 # Currently this is hard-coded, solely based on what I think is most important
 DATA_STORAGE_PREFERENCE = [DataStorageType.SQL, DataStorageType.CSV]
 
+SUMMARY_CHUNK_SIZE = 10000
+STREAM_CHUNK_SIZE = 2000
+CSV_FILE_CACHE_SIZE = 32
+OVER_BUDGET_ACTIONS = ("downsample", "reject")
+RANGE_AGGREGATES = ("min", "max", "avg", "sum", "last")
+PAGE_ORDERS = ("desc", "asc")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
 
 class DataInterface(ABC):
     @staticmethod
@@ -21,114 +42,968 @@ class DataInterface(ABC):
         for preference in DATA_STORAGE_PREFERENCE:
             if preference == DataStorageType.CSV:
                 if "csv_data_logging" in config:
-                    raise NotImplementedError("CSV data storage not yet implemented!")
+                    data_interface = CsvDataInterface(config["csv_data_logging"]["base_filepath"])
+                    return DataInterface.add_result_cache(data_interface, config)
             elif preference == DataStorageType.SQL:
                 if "sql_database" in config:
-                    sql_connection_string = sql_utilities.get_sql_connection_string(
-                        config["sql_database"]["sql_driver"], config["sql_database"]["database_path"])
-                    return SQLDataInterface(sql_connection_string)
+                    sql_config = config["sql_database"]
+                    sql_connection_string = sql_utilities.get_sql_connection_string(sql_config["sql_driver"],
+                                                                                    sql_config["database_path"])
+                    data_interface = SQLDataInterface(
+                        sql_connection_string,
+                        epoch_millisecond_keys=sql_config.get("epoch_millisecond_keys", False),
+                        rollup_tiers=sql_utilities.get_rollup_tiers(sql_config),
+                        min_chart_points=sql_config.get("min_chart_points", 300),
+                        partition_interval=sql_config.get("partitioning", {}).get("interval"),
+                        detach_expired_partitions=sql_config.get("partitioning", {}).get("detach_expired", False),
+                        sqlite_profile=sql_config.get("sqlite_profile"),
+                        read_connection_string=sql_utilities.get_read_connection_string(sql_config),
+                        pool_settings=sql_config.get("pools"),
+                        row_budget=sql_config.get("row_budget"),
+                        over_budget=sql_config.get("over_budget", "downsample"),
+                        compact_arrays=sql_config.get("compact_arrays", False),
+                        ingest_compression=sql_config.get("ingest_compression"),
+                        archive_settings=config.get("archive"))
+                    return DataInterface.add_result_cache(data_interface, config)
 
         raise ValueError("No valid data storage types found in config!")
 
+    @staticmethod
+    def add_result_cache(data_interface: "DataInterface", config: dict) -> "DataInterface":
+        if "result_cache" not in config:
+            return data_interface
+
+        # Imported here, since the cache is itself a data interface
+        from data_management.result_cache import CachedDataInterface
+        return CachedDataInterface(data_interface, config["result_cache"].get("max_entries", 256),
+                                   config["result_cache"].get("ttl", 5.0))
+
     @abstractmethod
     async def get_last_n_entries(self, device_id: str, n: int, columns: list[str] = None):
         pass
 
     @abstractmethod
-    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None):
+    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None, max_points: int = None,
+                                 downsample_mode: str = "average", history: DeviceRingBuffer = None):
         pass
 
-    async def get_last_n_hours(self, device_id: str, n: int, columns: list[str] = None):
-        return await self.get_last_n_minutes(device_id, n * 60, columns)
+    async def get_last_n_hours(self, device_id: str, n: int, columns: list[str] = None, max_points: int = None,
+                               downsample_mode: str = "average", history: DeviceRingBuffer = None):
+        return await self.get_last_n_minutes(device_id, n * 60, columns, max_points, downsample_mode, history)
+
+    async def get_entries_page(self, device_id: str, page_size: int, columns: list[str] = None, order: str = "desc",
+                               page_token: str = None) -> tuple[dict, str]:
+        # Returns a page of entries along with the token for the next one, which is None after the last page
+        raise NotImplementedError(f"Paging is not supported by {type(self).__name__}")
+
+    async def get_aligned_minutes(self, series: dict[str, tuple], n: int, max_points: int = None,
+                                  tolerance: float = None):
+        # series maps each device key to its (device_id, columns, history), and the first device's samples set the
+        # time axis. The other devices are read a minute further back, so the first rows have something to match
+        series_results = await asyncio.gather(*[
+            self.get_last_n_minutes(device_id, n if i == 0 else n + 1, ["time_updated", *columns],
+                                    max_points if i == 0 else None, "average", history)
+            for i, (device_id, columns, history) in enumerate(series.values())])
+
+        device_keys = list(series)
+        other_results = {device_key: result or {column: [] for column in ["time_updated", *series[device_key][1]]}
+                         for device_key, result in zip(device_keys[1:], series_results[1:])}
+        return alignment.asof_join(device_keys[0], series_results[0], other_results, tolerance)
+
+    @staticmethod
+    def get_hot_timestamp(history: DeviceRingBuffer, columns: list[str] = None):
+        # The history only has what the device reports, so like the tiers it can only be used with explicit columns
+        if history is None or not columns or "time_updated" not in columns or not history.has_columns(columns):
+            return None
+
+        return history.get_oldest_timestamp()
+
+    def stream_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None,
+                              chunk_size: int = STREAM_CHUNK_SIZE):
+        # Returns an async iterator of column-wise chunks. Not every kind of storage can do this
+        raise NotImplementedError(f"Streaming is not supported by {type(self).__name__}")
+
+    def get_cache_statistics(self) -> dict:
+        raise NotImplementedError(f"{type(self).__name__} doesn't cache results")
 
     @abstractmethod
     async def get_when_grid_last_on(self):
         pass
 
+    async def get_range_aggregates(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                   bucket_seconds: float, columns: list[str] = None, aggregates: list[str] = None):
+        raise NotImplementedError(f"Range aggregates are not supported by {type(self).__name__}")
+
+    async def get_archived_range(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                 columns: list[str] = None, table: str = "raw", max_points: int = None,
+                                 downsample_mode: str = "average"):
+        raise NotImplementedError(f"Archives are not supported by {type(self).__name__}")
+
+    async def get_grid_outages(self, device_id: str, days: float):
+        raise NotImplementedError(f"Grid outages are not recorded by {type(self).__name__}")
+
+    async def get_daily_outage_totals(self, device_id: str, days: int):
+        raise NotImplementedError(f"Grid outages are not recorded by {type(self).__name__}")
+
     @abstractmethod
     async def summarise_data(self, device_id: str, cutoff_timestamp: int):
         pass
 
 
 class SQLDataInterface(DataInterface):
-    def __init__(self, sql_connection_string: str):
-        self.engine = create_async_engine(sql_connection_string)
+    # Everything after the connection string is keyword only, since there are too many settings to keep in order
+    def __init__(self, sql_connection_string: str, *, epoch_millisecond_keys: bool = False,
+                 rollup_tiers: list[int] = None, min_chart_points: int = 300, partition_interval: str = None,
+                 detach_expired_partitions: bool = False, sqlite_profile: dict = None,
+                 read_connection_string: str = None, pool_settings: dict = None, row_budget: int = None,
+                 over_budget: str = "downsample", compact_arrays: bool = False, ingest_compression: dict = None,
+                 archive_settings: dict = None):
+        pool_settings = pool_settings or {}
+        # Summarising and deleting share the ingest session's pool, while queries get their own, optionally pointed
+        # at a read-only replica
+        self.engine = sql_utilities.get_engine(sql_connection_string, pool_settings.get("write"), sqlite_profile)
+        self.read_engine = sql_utilities.get_engine(read_connection_string or sql_connection_string,
+                                                    pool_settings.get("read"), sqlite_profile)
+        if over_budget not in OVER_BUDGET_ACTIONS:
+            raise ValueError(f"Unknown over budget action '{over_budget}', expected one of {OVER_BUDGET_ACTIONS}")
+        self.row_budget = row_budget
+        self.over_budget = over_budget
+        self.compact_arrays = compact_arrays
+        check_compression_settings(ingest_compression, rollup_tiers)
+        self.ingest_compression = ingest_compression
+        self.archive_settings = archive_settings
+        self.partition_interval = partition_interval if self.engine.dialect.name == "postgresql" else None
+        self.detach_expired_partitions = detach_expired_partitions
+        self.rollup_tiers = rollup_tiers
+        self.streaming_rollups = rollup_tiers is not None
+        self.min_chart_points = min_chart_points
+        self.query_cache = sql_utilities.StatementCache()
+        self.catalog = SchemaCatalog.for_connection_string(sql_connection_string)
+        self.catalog_version = self.catalog.version
+        self.epoch_millisecond_keys = epoch_millisecond_keys
+        # Range scans and ordering go through the integer time key when the tables have one. Partitions are keyed on
+        # time_updated though, and Postgres can only prune them by a filter on that
+        self.time_column = "time_key" if epoch_millisecond_keys and not self.partition_interval else "time_updated"
+
+    def time_bound(self, timestamp: float):
+        return sql_utilities.get_time_key(timestamp) if self.time_column == "time_key" else timestamp
+
+    def cached_query(self, query_name: str, device_id: str, columns: list[str], build_sql: callable):
+        # The column list is part of the SQL, so it's part of the key. Everything else is a bound parameter
+        cache_key = (query_name, device_id, tuple(columns) if columns else None)
+
+        # Queries that select everything depend on the schema, so anything built before DDL was issued is stale
+        if self.catalog.version != self.catalog_version:
+            self.query_cache.clear()
+            self.catalog_version = self.catalog.version
+
+        return self.query_cache.get(cache_key, lambda: text(build_sql()))
+
+    def get_stored_columns(self, columns: list[str] = None):
+        return compact_arrays.get_stored_columns(columns) if self.compact_arrays else columns
+
+    def expand_result(self, result: dict, columns: list[str] = None) -> dict:
+        # With the compact layout, results are unpacked back into the per-cell columns before they go anywhere else
+        return compact_arrays.expand_result(result, columns) if self.compact_arrays else result
+
+    async def get_catalog_metadata(self, connection, device_id: str) -> MetaData:
+        await self.catalog.load(connection, sql_utilities.get_device_table_names(device_id, self.rollup_tiers))
+        return self.catalog.metadata
 
     async def get_last_n_entries(self, device_id: str, n: int, columns: list[str] = None):
-        async with self.engine.connect() as connection:
+        async with self.read_engine.connect() as connection:
             table_name = sql_utilities.get_table_name(device_id)
-            selection_columns = sql_utilities.get_selection_columns(columns)
+            stored_columns = self.get_stored_columns(columns)
+            selection_columns = sql_utilities.get_selection_columns(stored_columns)
 
-            query = text(f"SELECT {selection_columns} FROM {table_name} ORDER BY time_updated DESC LIMIT {n}")
-            result = await connection.execute(query)
+            query = self.cached_query(
+                "last_n_entries", device_id, stored_columns,
+                lambda: f"SELECT {selection_columns} FROM {table_name} ORDER BY {self.time_column} DESC LIMIT :n")
+            if self.row_budget is not None and n > self.row_budget:
+                if self.over_budget == "reject":
+                    raise QueryBudgetExceeded(f"More than {self.row_budget} entries requested")
+                n = self.row_budget
+
+            result = await connection.execute(query, {"n": n})
             results_dictionary = sql_utilities.convert_cursor_result_to_dict(result)
-            return results_dictionary
+            return self.expand_result(results_dictionary, columns)
 
-    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None):
-        async with self.engine.connect() as connection:
-            table_name = sql_utilities.get_table_name(device_id)
-            selection_columns = sql_utilities.get_selection_columns(columns)
+    async def get_entries_page(self, device_id: str, page_size: int, columns: list[str] = None, order: str = "desc",
+                               page_token: str = None) -> tuple[dict, str]:
+        # Keyset pagination: each page carries on from the (time, id) of the last row of the one before, so every page
+        # is a short range scan on the time index, however deep into the table it is
+        if order not in PAGE_ORDERS:
+            raise ValueError(f"Unknown order '{order}', expected one of {PAGE_ORDERS}")
+        if page_size < 1:
+            raise ValueError("The page size has to be at least 1")
+        if self.row_budget is not None and page_size > self.row_budget:
+            if self.over_budget == "reject":
+                raise QueryBudgetExceeded(f"Pages of more than {self.row_budget} entries requested")
+            page_size = self.row_budget
 
-            past_timestamp = time() - n * 60
-            query = text(
-                f"SELECT {selection_columns} FROM {table_name} WHERE time_updated >= {past_timestamp} ORDER BY time_updated")
-            result = await connection.execute(query)
-            results_dictionary = sql_utilities.convert_cursor_result_to_dict(result)
-            return results_dictionary
+        table_name = sql_utilities.get_table_name(device_id)
+        stored_columns = self.get_stored_columns(columns)
+        selection_columns = sql_utilities.get_selection_columns(stored_columns)
+        comparison = "<" if order == "desc" else ">"
+
+        def build_sql(after_filter: str) -> str:
+            # The time and id are selected under their own names, since they might not be among the columns asked for
+            return (f"SELECT {selection_columns}, {self.time_column} AS page_time, id AS page_id FROM {table_name}"
+                    f"{after_filter} ORDER BY {self.time_column} {order}, id {order} LIMIT :page_limit")
+
+        parameters = {"page_limit": page_size + 1}
+        if page_token is None:
+            query = self.cached_query(f"first_page_{order}", device_id, stored_columns, lambda: build_sql(""))
+        else:
+            parameters["page_time"], parameters["page_id"] = sql_utilities.decode_page_token(page_token, order)
+            # The first condition on its own is what lets the database seek straight to the start of the page
+            query = self.cached_query(
+                f"next_page_{order}", device_id, stored_columns,
+                lambda: build_sql(f" WHERE {self.time_column} {comparison}= :page_time AND "
+                                  f"({self.time_column} {comparison} :page_time OR id {comparison} :page_id)"))
+
+        async with self.read_engine.connect() as connection:
+            result = sql_utilities.convert_cursor_result_to_dict(await connection.execute(query, parameters))
+
+        if not result:
+            return {}, None
+
+        # We ask for one row more than the page, which tells us whether there's another page without an extra query
+        page_times, page_ids = result.pop("page_time"), result.pop("page_id")
+        if len(page_ids) <= page_size:
+            return self.expand_result(result, columns), None
+
+        page = self.expand_result({key: values[:page_size] for key, values in result.items()}, columns)
+        return page, sql_utilities.encode_page_token(order, page_times[page_size - 1], page_ids[page_size - 1])
+
+    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None, max_points: int = None,
+                                 downsample_mode: str = "average", history: DeviceRingBuffer = None):
+        downsampling.validate_downsample_mode(downsample_mode)
+        now = time()
+        past_timestamp = now - n * 60
+        hot_timestamp = self.get_hot_timestamp(history, columns)
+
+        # Windows that fit in the device's in-memory history don't need the database at all
+        if hot_timestamp is not None and hot_timestamp <= past_timestamp:
+            return downsampling.downsample(history.get_since(past_timestamp, columns), max_points, downsample_mode)
+
+        if hot_timestamp is None:
+            async with self.read_engine.connect() as connection:
+                return await self.get_stored_rows_since(connection, device_id, past_timestamp, n * 60, columns,
+                                                        max_points, downsample_mode)
+
+        # Otherwise only the older part of the window comes from the database. When downsampling, each part gets a
+        # share of the points in proportion to how much of the window it covers
+        stored_points = hot_points = max_points
+        if max_points is not None:
+            hot_points = max(int(max_points * (now - hot_timestamp) / (n * 60)), 2)
+            stored_points = max(max_points - hot_points, 2)
+
+        async with self.read_engine.connect() as connection:
+            stored_result = await self.get_stored_rows_since(connection, device_id, past_timestamp,
+                                                             hot_timestamp - past_timestamp, columns, stored_points,
+                                                             downsample_mode, hot_timestamp)
+
+        # The tiers can reach a little past the start of the history, so we carry on from wherever they stopped
+        if stored_result:
+            hot_timestamp = max(hot_timestamp, stored_result["time_updated"][-1] + 1e-6)
+        hot_result = downsampling.downsample(history.get_since(hot_timestamp, columns), hot_points, downsample_mode)
+
+        return sql_utilities.concatenate_results([stored_result, hot_result])
+
+    async def get_stored_rows_since(self, connection, device_id: str, past_timestamp: float, window_seconds: float,
+                                    columns: list[str] = None, max_points: int = None, downsample_mode: str = "average",
+                                    until_timestamp: float = None):
+        requested_columns = columns
+        columns = self.get_stored_columns(columns)
+        query_tiers = self.get_query_tiers(window_seconds, columns)
+
+        if not query_tiers:
+            if self.row_budget is not None and max_points is not None:
+                max_points = min(max_points, self.row_budget)
+
+            # LTTB has to see every row, and the buckets have to be put back in order by time
+            can_bucket = not columns or "time_updated" in columns
+            if (max_points is None or downsample_mode == "lttb") and \
+                    await self.is_over_budget(connection, device_id, past_timestamp, until_timestamp):
+                if self.over_budget == "reject" or not can_bucket:
+                    raise QueryBudgetExceeded(f"The window has more than {self.row_budget} rows, ask for a shorter "
+                                              f"window or fewer points")
+
+                # Otherwise the window is bucketed down to the budget in the database. LTTB would need every row, so
+                # it gets the min/max envelope instead, which keeps the peaks too
+                max_points = min(max_points or self.row_budget, self.row_budget)
+                downsample_mode = "minmax" if downsample_mode == "lttb" else downsample_mode
+
+            if max_points is not None and downsample_mode != "lttb" and can_bucket:
+                if self.ingest_compression is not None:
+                    return self.expand_result(
+                        await self.get_compressed_buckets_since(connection, device_id, past_timestamp, window_seconds,
+                                                                columns, max_points, downsample_mode, until_timestamp),
+                        requested_columns)
+
+                return self.expand_result(
+                    await self.get_bucketed_rows_since(connection, device_id, past_timestamp, window_seconds, columns,
+                                                       max_points, downsample_mode, until_timestamp),
+                    requested_columns)
+
+            result = await self.get_raw_rows_since(connection, device_id, past_timestamp, columns, until_timestamp)
+            return downsampling.downsample(self.expand_result(result, requested_columns), max_points, downsample_mode)
+
+        results = await self.get_tier_rows_since(connection, device_id, query_tiers, past_timestamp, columns,
+                                                 until_timestamp)
+        # The tiers have already done most of the work, so this is only ever a pass over a few thousand rows
+        result = self.expand_result(sql_utilities.concatenate_results(results), requested_columns)
+        return downsampling.downsample(result, max_points, downsample_mode)
+
+    async def get_tier_rows_since(self, connection, device_id: str, query_tiers: list[int], past_timestamp: float,
+                                  columns: list[str], until_timestamp: float = None) -> list[dict]:
+        # Reads the window from the coarsest tier, then fills in the buckets it hasn't closed yet from each finer tier
+        # in turn, and finally from the raw table. A tier only has buckets from when the streaming rollups were turned
+        # on, so whatever comes before its first bucket is filled in from the finer tiers (the summary going back to
+        # the batch summaries) in the same way
+        if not query_tiers:
+            return [await self.get_raw_rows_since(connection, device_id, past_timestamp, columns, until_timestamp)]
+
+        bucket_seconds = query_tiers[0]
+        tier_name = sql_utilities.get_rollup_name(device_id, bucket_seconds)
+        selection_columns = sql_utilities.get_selection_columns(columns)
+        until_filter = " AND time_updated < :until_timestamp" if until_timestamp is not None else ""
+        query = self.cached_query(
+            f"tier_{bucket_seconds}_since{'_until' if until_filter else ''}", device_id, columns,
+            lambda: f"SELECT {selection_columns} FROM {tier_name} WHERE time_updated >= :past_timestamp"
+                    f"{until_filter} ORDER BY time_updated")
+        parameters = {"past_timestamp": past_timestamp}
+        if until_timestamp is not None:
+            parameters["until_timestamp"] = until_timestamp
+        result = sql_utilities.convert_cursor_result_to_dict(await connection.execute(query, parameters))
+
+        if not result:
+            return await self.get_tier_rows_since(connection, device_id, query_tiers[1:], past_timestamp, columns,
+                                                  until_timestamp)
+
+        # Buckets are labelled by their end, so the first one starts a bucket before its label
+        results = []
+        tier_start = result["time_updated"][0] - bucket_seconds
+        if tier_start > past_timestamp:
+            results += await self.get_tier_rows_since(connection, device_id, query_tiers[1:], past_timestamp, columns,
+                                                      tier_start + 1e-6)
+        results.append(result)
+        results += await self.get_tier_rows_since(connection, device_id, query_tiers[1:],
+                                                  result["time_updated"][-1] + 1e-6, columns, until_timestamp)
+        return results
+
+    async def is_over_budget(self, connection, device_id: str, past_timestamp: float,
+                             until_timestamp: float = None) -> bool:
+        if self.row_budget is None:
+            return False
+
+        # The count stops as soon as it passes the budget, so the check never costs more than the budget itself
+        table_name = sql_utilities.get_table_name(device_id)
+        until_filter = self.get_until_filter(until_timestamp)
+        query = self.cached_query(
+            "row_budget_until" if until_filter else "row_budget", device_id, None,
+            lambda: f"SELECT count(*) FROM (SELECT 1 FROM {table_name} WHERE {self.time_column} >= :past_timestamp"
+                    f"{until_filter} LIMIT :row_limit) AS budget_rows")
+        result = await connection.execute(query, {**self.get_time_parameters(past_timestamp, until_timestamp),
+                                                  "row_limit": self.row_budget + 1})
+        return result.scalar() > self.row_budget
+
+    def get_query_tiers(self, window_seconds: int, columns: list[str] = None) -> list[int]:
+        # The rollup tables have extra columns, so we can only mix them with raw rows when the columns are explicit.
+        # They also need to include time_updated so that we know where each tier stops
+        if not self.rollup_tiers or not columns or "time_updated" not in columns:
+            return []
+
+        coarse_enough_tiers = [bucket_seconds for bucket_seconds in self.rollup_tiers if
+                               window_seconds / bucket_seconds >= self.min_chart_points]
+        if not coarse_enough_tiers:
+            return []
+
+        coarsest_tier = coarse_enough_tiers[-1]
+        return [bucket_seconds for bucket_seconds in reversed(self.rollup_tiers) if bucket_seconds <= coarsest_tier]
+
+    def get_until_filter(self, until_timestamp: float = None) -> str:
+        return f" AND {self.time_column} < :until_timestamp" if until_timestamp is not None else ""
+
+    def get_time_parameters(self, past_timestamp: float, until_timestamp: float = None) -> dict:
+        parameters = {"past_timestamp": self.time_bound(past_timestamp)}
+        if until_timestamp is not None:
+            parameters["until_timestamp"] = self.time_bound(until_timestamp)
+
+        return parameters
+
+    def get_raw_rows_since_query(self, device_id: str, columns: list[str] = None, until_timestamp: float = None):
+        table_name = sql_utilities.get_table_name(device_id)
+        selection_columns = sql_utilities.get_selection_columns(columns)
+        until_filter = self.get_until_filter(until_timestamp)
+
+        return self.cached_query(
+            "last_n_minutes_until" if until_filter else "last_n_minutes", device_id, columns,
+            lambda: f"SELECT {selection_columns} FROM {table_name} WHERE {self.time_column} >= :past_timestamp"
+                    f"{until_filter} ORDER BY {self.time_column}")
+
+    async def get_raw_rows_since(self, connection, device_id: str, past_timestamp: float, columns: list[str] = None,
+                                 until_timestamp: float = None, reconstruct: bool = True):
+        query = self.get_raw_rows_since_query(device_id, columns, until_timestamp)
+        result = await connection.execute(query, self.get_time_parameters(past_timestamp, until_timestamp))
+        result = sql_utilities.convert_cursor_result_to_dict(result)
+        if self.ingest_compression is None:
+            return result
+
+        result = await self.carry_row_before(connection, device_id, past_timestamp, columns, result)
+        if reconstruct and self.ingest_compression.get("method", "deadband") == "deadband":
+            return reconstruct_steps(result)
+
+        return result
+
+    async def get_compressed_buckets_since(self, connection, device_id: str, past_timestamp: float,
+                                           window_seconds: float, columns: list[str], max_points: int,
+                                           downsample_mode: str, until_timestamp: float = None) -> dict:
+        # Compressed rows stand for every sample in between them, so averaging the rows as they are would favour the
+        # moments when something changed. Instead each bucket is weighted by how long each value held, which can't be
+        # done portably in SQL, but there are only as many rows as there were changes
+        result = await self.get_raw_rows_since(connection, device_id, past_timestamp, columns, until_timestamp,
+                                               reconstruct=False)
+        method = self.ingest_compression.get("method", "deadband")
+        if len(result.get("time_updated", ())) <= max_points:
+            return reconstruct_steps(result) if method == "deadband" else result
+
+        return downsampling.downsample_by_time(result, past_timestamp, past_timestamp + window_seconds, max_points,
+                                               downsample_mode, "step" if method == "deadband" else "linear",
+                                               self.ingest_compression.get("heartbeat", 60))
+
+    async def carry_row_before(self, connection, device_id: str, past_timestamp: float, columns: list[str],
+                               result: dict) -> dict:
+        # With compression, a window can start (or even end) in the middle of a flat stretch, so the last row stored
+        # before the window is carried forward to its start. Rows older than a heartbeat are left alone though, since
+        # then the device wasn't reporting at all
+        table_name = sql_utilities.get_table_name(device_id)
+        selection_columns = sql_utilities.get_selection_columns(columns)
+        query = self.cached_query(
+            "row_before", device_id, columns,
+            lambda: f"SELECT {selection_columns} FROM {table_name} WHERE {self.time_column} < :past_timestamp "
+                    f"ORDER BY {self.time_column} DESC LIMIT 1")
+        row_before = sql_utilities.convert_cursor_result_to_dict(
+            await connection.execute(query, {"past_timestamp": self.time_bound(past_timestamp)}))
+
+        if row_before and "time_updated" in row_before and \
+                past_timestamp - row_before["time_updated"][0] <= self.ingest_compression.get("heartbeat", 60):
+            row_before["time_updated"] = (past_timestamp,)
+            if "time_key" in row_before:
+                row_before["time_key"] = (sql_utilities.get_time_key(past_timestamp),)
+            result = sql_utilities.concatenate_results([row_before, result])
+
+        return result
+
+    async def stream_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None,
+                                    chunk_size: int = STREAM_CHUNK_SIZE):
+        # Yields the raw rows in column-wise chunks from a server-side cursor (or SQLite's own cursor), so only one
+        # chunk is ever held in memory however long the window is
+        past_timestamp = time() - n * 60
+        query = self.get_raw_rows_since_query(device_id, self.get_stored_columns(columns))
+
+        async with self.read_engine.connect() as connection:
+            result = await connection.stream(query, {"past_timestamp": self.time_bound(past_timestamp)})
+            keys = list(result.keys())
+            async for rows in result.partitions(chunk_size):
+                yield self.expand_result(dict(zip(keys, zip(*rows))), columns)
+
+    async def get_bucketed_rows_since(self, connection, device_id: str, past_timestamp: float, window_seconds: float,
+                                      columns: list[str], max_points: int, downsample_mode: str,
+                                      until_timestamp: float = None):
+        # Buckets the raw rows in the database, so only max_points rows ever leave it however long the window is
+        num_buckets = downsampling.get_num_buckets(max_points, downsample_mode)
+        bucket_seconds = downsampling.get_bucket_seconds(window_seconds, max_points, downsample_mode)
+        table_name = sql_utilities.get_table_name(device_id)
+        await self.catalog.load(connection, [table_name])
+        table_columns = self.catalog.get_table(table_name).columns
+        selected_columns = [column for column in table_columns if column.name != "id" and
+                            (not columns or column.name in columns)]
+
+        # Buckets are counted from the start of the window, so there are never more of them than were asked for.
+        # Anything at or after the end of the window (a sample that came in while we were reading) goes in the last
+        if self.time_column == "time_key":
+            offset_bucket_sql = "(time_key - :past_timestamp) / :bucket_width"
+        elif self.read_engine.dialect.name == "sqlite":
+            # Offsets in the window are never negative, so truncating is the same as flooring, and SQLite doesn't
+            # always have FLOOR
+            offset_bucket_sql = "CAST((time_updated - :past_timestamp) / :bucket_width AS INTEGER)"
+        else:
+            offset_bucket_sql = "FLOOR((time_updated - :past_timestamp) / :bucket_width)"
+        bucket_sql = f"CASE WHEN {offset_bucket_sql} < :num_buckets THEN {offset_bucket_sql} ELSE :num_buckets - 1 END"
+
+        aggregated_names = [column.name for column in selected_columns if
+                            column.name in ("time_updated", "time_key") or column.type.python_type in (int, float)]
+        latest_names = [column.name for column in selected_columns if column.name not in aggregated_names]
+
+        def build_selection(numeric_aggregate: str, time_aggregate: str) -> str:
+            return ", ".join(f"{time_aggregate if name in ('time_updated', 'time_key') else numeric_aggregate}({name}) "
+                             f"AS {name}" for name in aggregated_names)
+
+        def build_bucket_query(numeric_aggregate: str, time_aggregate: str) -> str:
+            where_sql = f"WHERE {self.time_column} >= :past_timestamp{until_filter}"
+            if not latest_names:
+                return (f"SELECT {build_selection(numeric_aggregate, time_aggregate)} FROM {table_name} {where_sql} "
+                        f"GROUP BY {bucket_sql}")
+
+            # Text and packed arrays can't be aggregated, so they take the bucket's most recent row, like the
+            # summaries do. There's no portable "last value" aggregate, so it's picked out with row_number()
+            return (f"SELECT {', '.join(f'bucket_group.{name}' for name in aggregated_names)}, "
+                    f"{', '.join(f'latest_row.{name}' for name in latest_names)} FROM "
+                    f"(SELECT {bucket_sql} AS bucket, {build_selection(numeric_aggregate, time_aggregate)} "
+                    f"FROM {table_name} {where_sql} GROUP BY {bucket_sql}) AS bucket_group INNER JOIN "
+                    f"(SELECT * FROM (SELECT {bucket_sql} AS bucket, {', '.join(latest_names)}, row_number() "
+                    f"OVER (PARTITION BY {bucket_sql} ORDER BY {self.time_column} DESC) AS row_num "
+                    f"FROM {table_name} {where_sql}) AS ranked WHERE row_num = 1) AS latest_row "
+                    f"ON bucket_group.bucket = latest_row.bucket")
+
+        def build_sql():
+            if downsample_mode == "minmax":
+                # An envelope of two rows per bucket: the minima at the start of the bucket and the maxima at the end
+                return (f"SELECT * FROM ({build_bucket_query('min', 'min')} UNION ALL "
+                        f"{build_bucket_query('max', 'max')}) AS envelope ORDER BY time_updated")
+
+            return f"{build_bucket_query('avg', 'avg')} ORDER BY time_updated"
+
+        until_filter = self.get_until_filter(until_timestamp)
+        query = self.cached_query(f"bucketed_{downsample_mode}{'_until' if until_filter else ''}", device_id, columns,
+                                  build_sql)
+        if self.time_column == "time_key":
+            bucket_width = max(int(bucket_seconds * 1000), 1)
+        else:
+            bucket_width = bucket_seconds
+        result = await connection.execute(query, {**self.get_time_parameters(past_timestamp, until_timestamp),
+                                                  "bucket_width": bucket_width, "num_buckets": num_buckets})
+        return sql_utilities.convert_cursor_result_to_dict(result)
 
     async def get_when_grid_last_on(self, device_id: str):
-        async with self.engine.connect() as connection:
+        async with self.read_engine.connect() as connection:
             table_name = sql_utilities.get_table_name(device_id)
+            outage_table_name = sql_utilities.get_outage_table_name(device_id)
 
-            query = text(
-                f"SELECT time_updated FROM {table_name} WHERE grid_state = 'on' ORDER BY time_updated DESC LIMIT 1")
-            result = await connection.execute(query)
-            results_dictionary = {'time_grid_last_on': result.first()[0]}
-            return results_dictionary
+            # With an outage table this is two index lookups: during an outage it's when the outage started, and
+            # otherwise the grid is on right now, so it's the latest sample
+            await self.catalog.load(connection, [outage_table_name])
+            if self.catalog.has_table(outage_table_name):
+                query = self.cached_query(
+                    "latest_outage", device_id, None,
+                    lambda: f"SELECT last_on, ended FROM {outage_table_name} ORDER BY started DESC LIMIT 1")
+                latest_outage = (await connection.execute(query)).first()
+                if latest_outage is not None and latest_outage.ended is None:
+                    return {'time_grid_last_on': latest_outage.last_on}
 
-    async def summarise_data(self, device_id: str, cutoff_timestamp: int):
-        async with self.engine.connect() as connection:
-            metadata = MetaData()
-            await connection.run_sync(metadata.create_all)
-            await connection.run_sync(metadata.reflect)
-            table_name = sql_utilities.get_table_name(device_id)
+                query = self.cached_query(
+                    "latest_sample", device_id, None,
+                    lambda: f"SELECT time_updated FROM {table_name} ORDER BY {self.time_column} DESC LIMIT 1")
+                latest_sample = (await connection.execute(query)).first()
+                if latest_sample is not None:
+                    return {'time_grid_last_on': latest_sample[0]}
 
-            outer_sql = "select main_group.leading_minute as time_updated"
-            averaging_sql = "select CEIL(time_updated / 60) * 60 as leading_minute"
-            most_recent_sql = "select ceil(time_updated/ 60) * 60 as leading_minute, row_number() over(partition by FLOOR(time_updated / 60) * 60 order by time_updated desc) as row_num"
-            ordered_columns = ["time_updated"]
+            # Without one we have to search back for it, through the summary as well in case it's been summarised
+            view_name = sql_utilities.get_view_name(device_id)
+            query = self.cached_query(
+                "grid_last_on", device_id, None,
+                lambda: f"SELECT time_updated FROM {view_name} WHERE grid_state = 'on' "
+                        f"ORDER BY time_updated DESC LIMIT 1")
+            result = (await connection.execute(query)).first()
+            if result is None:
+                return None
 
-            for column in metadata.tables[table_name].columns:
-                if column.name in ("id", "time_updated"):
-                    continue
+            return {'time_grid_last_on': result[0]}
+
+    async def get_range_aggregates(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                   bucket_seconds: float, columns: list[str] = None, aggregates: list[str] = None):
+        # Buckets are counted from the start of the range, so a range that starts at midnight gives calendar days.
+        # Everything is read through the view, so summarised history is included (each summarised minute counting
+        # as one sample)
+        aggregates = aggregates or ["avg"]
+        for aggregate in aggregates:
+            if aggregate not in RANGE_AGGREGATES:
+                raise ValueError(f"Unknown aggregate '{aggregate}', expected one of {RANGE_AGGREGATES}")
+        if bucket_seconds <= 0 or end_timestamp <= start_timestamp:
+            raise ValueError("The bucket size and the range both have to be positive")
+
+        num_buckets = (end_timestamp - start_timestamp) / bucket_seconds
+        if self.row_budget is not None and num_buckets > self.row_budget:
+            raise QueryBudgetExceeded(f"The range has {int(num_buckets)} buckets, more than the {self.row_budget} "
+                                      f"allowed, ask for bigger buckets")
+
+        table_name = sql_utilities.get_table_name(device_id)
+        view_name = sql_utilities.get_view_name(device_id)
+
+        async with self.read_engine.connect() as connection:
+            await self.catalog.load(connection, [table_name, view_name])
+            if not self.catalog.has_table(table_name):
+                return {}
+
+            # The view's column types don't always survive reflection, so we go by the raw table's
+            table_columns = {column.name: column for column in self.catalog.get_table(table_name).columns if
+                             column.name not in ("id", "time_updated", "time_key")}
+            columns = self.get_stored_columns(columns)
+            for column in columns or []:
+                if column not in table_columns:
+                    raise ValueError(f"Unknown column '{column}' for device {device_id}")
+            selected_columns = columns or list(table_columns)
+            numeric_columns = [column for column in selected_columns if
+                               table_columns[column].type.python_type in (int, float)]
+
+            def build_sql():
+                if self.read_engine.dialect.name == "sqlite":
+                    bucket_sql = "CAST((time_updated - :start_timestamp) / :bucket_seconds AS INTEGER)"
+                else:
+                    bucket_sql = "FLOOR((time_updated - :start_timestamp) / :bucket_seconds)"
+
+                aggregated_selections = ["count(*) AS samples", "max(time_updated) AS last_time"]
+                outer_selections = [":start_timestamp + aggregated.bucket * :bucket_seconds AS bucket_start",
+                                    "aggregated.samples"]
+                for column in numeric_columns:
+                    for aggregate in aggregates:
+                        if aggregate != "last":
+                            aggregated_selections.append(f"{aggregate}({column}) AS {column}_{aggregate}")
+                            outer_selections.append(f"aggregated.{column}_{aggregate}")
+
+                # The last value in each bucket is a join back to the row at that bucket's latest time, and it works
+                # for text columns as well as numbers
+                last_join_sql = ""
+                if "last" in aggregates:
+                    outer_selections += [f"bucketed.{column} AS {column}_last" for column in selected_columns]
+                    last_join_sql = ("JOIN bucketed ON bucketed.bucket = aggregated.bucket "
+                                     "AND bucketed.time_updated = aggregated.last_time ")
+
+                return (f"WITH bucketed AS (SELECT {bucket_sql} AS bucket, time_updated, "
+                        f"{', '.join(selected_columns)} FROM {view_name} WHERE time_updated >= :start_timestamp "
+                        f"AND time_updated < :end_timestamp), "
+                        f"aggregated AS (SELECT bucket, {', '.join(aggregated_selections)} FROM bucketed "
+                        f"GROUP BY bucket) "
+                        f"SELECT {', '.join(outer_selections)} FROM aggregated {last_join_sql}"
+                        f"ORDER BY aggregated.bucket")
+
+            query = self.cached_query(f"range_{'_'.join(aggregates)}", device_id, selected_columns, build_sql)
+            result = await connection.execute(query, {"start_timestamp": float(start_timestamp),
+                                                      "end_timestamp": float(end_timestamp),
+                                                      "bucket_seconds": float(bucket_seconds)})
+            # Every element of a packed column comes back, since the names here have the aggregate on the end
+            return self.expand_result(sql_utilities.convert_cursor_result_to_dict(result))
+
+    async def get_archived_range(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                 columns: list[str] = None, table: str = "raw", max_points: int = None,
+                                 downsample_mode: str = "average"):
+        # Reads from the Parquet files that the archiver exported, which go back further than retention lets the
+        # database. Reading them is blocking work, so it's done in a thread
+        if self.archive_settings is None:
+            raise NotImplementedError("No archive is configured")
+        if archive.pyarrow is None:
+            raise NotImplementedError("Reading the archive needs the pyarrow package")
+        downsampling.validate_downsample_mode(downsample_mode)
+        if end_timestamp <= start_timestamp:
+            raise ValueError("The range has to be positive")
+
+        result = await asyncio.to_thread(archive.read_archive, self.archive_settings.get("directory", "archive"),
+                                         archive.get_archive_table_name(device_id, table), start_timestamp,
+                                         end_timestamp, self.get_stored_columns(columns),
+                                         self.archive_settings.get("interval", "daily"))
+
+        num_rows = len(result.get("time_updated", []))
+        if max_points is None and self.row_budget is not None and num_rows > self.row_budget:
+            if self.over_budget == "reject":
+                raise QueryBudgetExceeded(f"The range has {num_rows} rows, more than the {self.row_budget} allowed, "
+                                          f"ask for fewer points or a shorter range")
+            max_points = self.row_budget
+
+        return downsampling.downsample(self.expand_result(result, columns), max_points, downsample_mode)
 
-                if column.type.python_type == str:
-                    outer_sql += f", outer_group.{column.name} as {column.name}"
-                    ordered_columns.append(column.name)
-                    most_recent_sql += f", {column.name}"
-
-                elif column.type.python_type == float:
-                    outer_sql += f", main_group.{column.name} as {column.name}, main_group.{column.name}_stdev as {column.name}_stdev"
-                    ordered_columns.append(column.name)
-                    ordered_columns.append(f"{column.name}_stdev")
-                    averaging_sql += f", avg({column.name}) as {column.name}, stddev({column.name}) as {column.name}_stdev"
-
-            summary_name = sql_utilities.get_summary_name(device_id)
-            ordered_columns_string = ", ".join(ordered_columns)
-            full_query = (f"insert into {summary_name} ({ordered_columns_string}) {outer_sql} from ({averaging_sql} from {table_name} where time_updated <= {cutoff_timestamp} "
-                          f"group by FLOOR(time_updated / 60) * 60) as main_group inner join "
-                          f"(select * from ({most_recent_sql} from {table_name} WHERE time_updated <= {cutoff_timestamp}) "
-                          f"inner_group where inner_group.row_num = 1) outer_group on "
-                          f"main_group.leading_minute = outer_group.leading_minute "
-                          f"order by time_updated;")
+    async def get_grid_outages(self, device_id: str, days: float):
+        outage_table_name = sql_utilities.get_outage_table_name(device_id)
+        now = time()
+
+        async with self.read_engine.connect() as connection:
+            await self.catalog.load(connection, [outage_table_name])
+            if not self.catalog.has_table(outage_table_name):
+                return {}
+
+            query = self.cached_query(
+                "grid_outages", device_id, None,
+                lambda: f"SELECT last_on, started, ended FROM {outage_table_name} "
+                        f"WHERE ended IS NULL OR ended >= :past_timestamp ORDER BY started")
+            result = sql_utilities.convert_cursor_result_to_dict(
+                await connection.execute(query, {"past_timestamp": now - days * 24 * 60 * 60}))
+
+        if result:
+            # Outages that are still going are counted up to now
+            result["duration"] = [(ended if ended is not None else now) - started for started, ended in
+                                  zip(result["started"], result["ended"])]
+
+        return result
+
+    async def get_daily_outage_totals(self, device_id: str, days: int):
+        # Days are in the daemon's local time, since that's the day that the people in the house are living in
+        outages = await self.get_grid_outages(device_id, days)
+        now = time()
+        today = datetime.datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0)
+        day_starts = [today - datetime.timedelta(days=i) for i in reversed(range(days))]
+
+        totals = {"day": [day_start.date().isoformat() for day_start in day_starts], "outage_seconds": []}
+        for day_start in day_starts:
+            start = day_start.timestamp()
+            end = (day_start + datetime.timedelta(days=1)).timestamp()
+            total = 0.0
+            for started, ended in zip(outages.get("started", ()), outages.get("ended", ())):
+                ended = ended if ended is not None else now
+                total += max(0.0, min(ended, end) - max(started, start))
+            totals["outage_seconds"].append(total)
+
+        return totals
+
+    async def summarise_data(self, device_id: str, cutoff_timestamp: int):
+        table_name = sql_utilities.get_table_name(device_id)
+        # Only whole minutes are summarised, since a minute that's cut short would never be finished off. A minute
+        # ends on its label, so everything up to and including a cutoff on a boundary belongs to complete minutes
+        cutoff_timestamp = int(cutoff_timestamp // 60 * 60)
+
+        async with self.engine.begin() as connection:
+            metadata = await self.get_catalog_metadata(connection, device_id)
 
             try:
-                await connection.execute(text(full_query))
+                # With streaming rollups the daemon writes the summary as each minute closes, so this only picks up
+                # the rows from before they were turned on
+                if self.engine.dialect.name == "sqlite":
+                    await self.summarise_in_python(connection, metadata, device_id, cutoff_timestamp)
+                else:
+                    await self.summarise_in_database(connection, metadata, device_id, cutoff_timestamp)
 
-                # Drop all the summarised data from the main table
-                deletion_query = f"DELETE FROM {table_name} WHERE time_updated <= {cutoff_timestamp}"
-                await connection.execute(text(deletion_query))
+                # Nothing that hasn't made it into the summary is deleted, whatever the cutoff
+                summarised_until = await retention.get_summarised_until(connection,
+                                                                        sql_utilities.get_summary_name(device_id))
+                if summarised_until is None:
+                    return {"success": True}
+                cutoff_timestamp = min(cutoff_timestamp, summarised_until)
+
+                # Whole partitions go first, so there's only what's left in the partition that the cutoff falls in
+                if self.partition_interval and await partitions.is_partitioned(connection, table_name):
+                    await partitions.remove_partitions_before(connection, table_name, cutoff_timestamp,
+                                                              self.partition_interval, self.detach_expired_partitions)
             except Exception as e:
+                await connection.rollback()
                 return {"success": False, "error": str(e)}
 
-            return {"success": True}
+        # Drop all the summarised data from the main table, in chunks so we don't hold up ingest
+        try:
+            await retention.delete_in_chunks(self.engine, table_name, cutoff_timestamp)
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+        return {"success": True}
+
+    def get_unsummarised_filter(self, device_id: str) -> str:
+        # Raw rows that fall in a minute that's already been summarised are left out, so running this again after a
+        # partial failure doesn't duplicate minutes. With streaming rollups, the minutes after the first streamed one
+        # are the daemon's to write, so only the rows from before it are left (a row in a summarised minute is never
+        # a whole minute before its end)
+        summary_name = sql_utilities.get_summary_name(device_id)
+        if self.streaming_rollups:
+            return f"time_updated <= (select coalesce(min(time_updated) - 60, :cutoff_timestamp) from {summary_name})"
+
+        return f"time_updated > (select coalesce(max(time_updated), 0) from {summary_name})"
+
+    async def summarise_in_database(self, connection, metadata: MetaData, device_id: str, cutoff_timestamp: int):
+        table_name = sql_utilities.get_table_name(device_id)
+
+        # Each minute is labelled by its end (so a sample right on a boundary belongs to the minute that ends there),
+        # and we group on exactly the same expression that we select. Summarising always goes by time_updated rather
+        # than the truncated time key, since that's what the summarised rows are deleted by afterwards
+        leading_minute_sql = "CEIL(time_updated / 60) * 60"
+
+        outer_sql = "select main_group.leading_minute as time_updated"
+        averaging_sql = f"select {leading_minute_sql} as leading_minute"
+        most_recent_sql = f"select {leading_minute_sql} as leading_minute, row_number() over(partition by {leading_minute_sql} order by time_updated desc) as row_num"
+        ordered_columns = ["time_updated"]
+
+        if self.epoch_millisecond_keys:
+            outer_sql += ", main_group.leading_minute * 1000 as time_key"
+            ordered_columns.append("time_key")
+
+        for column in metadata.tables[table_name].columns:
+            if column.name in ("id", "time_updated", "time_key"):
+                continue
+
+            # Text and packed arrays both take the minute's most recent value
+            if column.type.python_type in (str, bytes, list):
+                outer_sql += f", outer_group.{column.name} as {column.name}"
+                ordered_columns.append(column.name)
+                most_recent_sql += f", {column.name}"
+
+            elif column.type.python_type == float:
+                outer_sql += f", main_group.{column.name} as {column.name}, main_group.{column.name}_stdev as {column.name}_stdev"
+                ordered_columns.append(column.name)
+                ordered_columns.append(f"{column.name}_stdev")
+                averaging_sql += f", avg({column.name}) as {column.name}, stddev({column.name}) as {column.name}_stdev"
+
+        summary_name = sql_utilities.get_summary_name(device_id)
+        ordered_columns_string = ", ".join(ordered_columns)
+        unsummarised_filter = self.get_unsummarised_filter(device_id)
+        full_query = (f"insert into {summary_name} ({ordered_columns_string}) {outer_sql} from ({averaging_sql} from {table_name} where time_updated <= :cutoff_timestamp and {unsummarised_filter} "
+                      f"group by {leading_minute_sql}) as main_group inner join "
+                      f"(select * from ({most_recent_sql} from {table_name} WHERE time_updated <= :cutoff_timestamp and {unsummarised_filter}) "
+                      f"inner_group where inner_group.row_num = 1) outer_group on "
+                      f"main_group.leading_minute = outer_group.leading_minute "
+                      f"order by time_updated;")
+
+        await connection.execute(text(full_query), {"cutoff_timestamp": cutoff_timestamp})
+
+    async def summarise_in_python(self, connection, metadata: MetaData, device_id: str, cutoff_timestamp: int):
+        # SQLite has neither CEIL nor stddev, so we stream the raw rows in chunks through the same rollup that the
+        # daemon uses for its streaming summaries
+        table_name = sql_utilities.get_table_name(device_id)
+        summary_table = metadata.tables[sql_utilities.get_summary_name(device_id)]
+        raw_columns = [column.name for column in metadata.tables[table_name].columns if
+                       column.name not in ("id", "time_key")]
+
+        query = text(f"SELECT {', '.join(raw_columns)} FROM {table_name} WHERE time_updated <= :cutoff_timestamp "
+                     f"AND {self.get_unsummarised_filter(device_id)} ORDER BY time_updated")
+        result = await connection.stream(query, {"cutoff_timestamp": cutoff_timestamp})
+
+        minute_rollup = BucketRollup(60)
+        async for rows in result.mappings().partitions(SUMMARY_CHUNK_SIZE):
+            finished_buckets = [minute_rollup.add(row) for row in rows]
+            await self.insert_summary_rows(connection, summary_table, [bucket for bucket in finished_buckets if bucket])
+
+        # The cutoff has been floored to a minute boundary, which is where the last bucket ends, so it's complete too
+        last_bucket = minute_rollup.finish()
+        if last_bucket is not None:
+            await self.insert_summary_rows(connection, summary_table, [last_bucket])
+
+    async def insert_summary_rows(self, connection, summary_table, finished_buckets: list[tuple]):
+        grouped_rows = {}
+        for finished_bucket in finished_buckets:
+            summary_row = get_bucket_row(finished_bucket)
+            if self.epoch_millisecond_keys:
+                summary_row["time_key"] = sql_utilities.get_time_key(summary_row["time_updated"])
+            grouped_rows.setdefault(tuple(summary_row.keys()), []).append(summary_row)
+
+        for summary_rows in grouped_rows.values():
+            await connection.execute(insert(summary_table), summary_rows)
+
+
+class CsvDataInterface(DataInterface):
+    # Reads what the CSV observers write, for installs without a database. Finished files are looked up in each
+    # device's time-range index, so a window only ever opens the files that overlap it, and since they never change
+    # again, the most recently read ones are kept parsed. Everything that touches the files happens in a thread
+    def __init__(self, base_filepath: str):
+        self.base_filepath = base_filepath
+
+    def get_file_ranges(self, device_id: str) -> list[tuple[str, float, float, bool]]:
+        # (path, first time, last time, finished) for each of the device's files, in time order. The file that's
+        # still being written isn't in the index yet, so it runs from the time in its name until the next file starts
+        index = csv_utilities.read_index(self.base_filepath, device_id)
+        filenames = csv_utilities.get_device_files(self.base_filepath, device_id)
+
+        file_ranges = []
+        for i, filename in enumerate(filenames):
+            if filename in index:
+                first_time, last_time = index[filename]
+            else:
+                first_time = csv_utilities.get_filename_timestamp(filename)
+                # The names only go down to the second, hence the extra second
+                last_time = csv_utilities.get_filename_timestamp(filenames[i + 1]) + 1 if i + 1 < len(filenames) \
+                    else math.inf
+            file_ranges.append((os.path.join(self.base_filepath, filename), first_time, last_time, filename in index))
+
+        return file_ranges
+
+    @staticmethod
+    def read_headers(path: str) -> list[str]:
+        with csv_utilities.open_text(path) as csv_file:
+            return next(csv.reader(csv_file), [])
+
+    @staticmethod
+    def read_file(path: str, keys: tuple[str]) -> dict:
+        # Files can have different fields (if the device started reporting more of them), so anything a file doesn't
+        # have comes back as None, which keeps every file's columns the same length
+        with csv_utilities.open_text(path) as csv_file:
+            reader = csv.reader(csv_file)
+            headers = next(reader, None)
+            if headers is None:
+                return {key: () for key in keys}
+
+            positions = [headers.index(key) if key in headers else None for key in keys]
+            columns = [[] for _ in keys]
+            for row in reader:
+                # A line that's only partly written yet is skipped, we'll get it next time
+                if len(row) != len(headers):
+                    continue
+
+                for column, position in zip(columns, positions):
+                    column.append(csv_utilities.parse_value(row[position]) if position is not None else None)
+
+        return dict(zip(keys, map(tuple, columns)))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=CSV_FILE_CACHE_SIZE)
+    def read_finished_file(path: str, keys: tuple[str]) -> dict:
+        return CsvDataInterface.read_file(path, keys)
+
+    def read_rows(self, file_ranges: list[tuple], columns: list[str] = None, past_timestamp: float = -math.inf) -> dict:
+        # Runs in a thread. Without explicit columns, we go by the newest file's fields
+        if not file_ranges:
+            return {}
+
+        keys = tuple(columns or self.read_headers(file_ranges[-1][0]))
+        results = []
+        for path, first_time, _, finished in file_ranges:
+            result = self.read_finished_file(path, keys) if finished else self.read_file(path, keys)
+            if first_time < past_timestamp and "time_updated" in result:
+                start = next((i for i, time_updated in enumerate(result["time_updated"]) if
+                              time_updated >= past_timestamp), len(result["time_updated"]))
+                result = {key: values[start:] for key, values in result.items()}
+            results.append(result)
+
+        result = sql_utilities.concatenate_results(results)
+        return result if result and result[keys[0]] else {}
+
+    async def get_last_n_entries(self, device_id: str, n: int, columns: list[str] = None):
+        # Works back from the newest file until there are enough rows, reading each file once
+        file_ranges = await asyncio.to_thread(self.get_file_ranges, device_id)
+        if not file_ranges:
+            return {}
+
+        columns = columns or await asyncio.to_thread(self.read_headers, file_ranges[-1][0])
+        results = []
+        num_rows = 0
+        while file_ranges and num_rows < n:
+            result = await asyncio.to_thread(self.read_rows, [file_ranges.pop()], columns)
+            if result:
+                results.insert(0, result)
+                num_rows += len(result[columns[0]])
+
+        # Newest first, the same as the database gives them
+        result = sql_utilities.concatenate_results(results)
+        return {key: values[::-1][:n] for key, values in result.items()}
+
+    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None, max_points: int = None,
+                                 downsample_mode: str = "average", history: DeviceRingBuffer = None):
+        downsampling.validate_downsample_mode(downsample_mode)
+        past_timestamp = time() - n * 60
+
+        hot_timestamp = self.get_hot_timestamp(history, columns)
+        if hot_timestamp is not None and hot_timestamp <= past_timestamp:
+            return downsampling.downsample(history.get_since(past_timestamp, columns), max_points, downsample_mode)
+
+        file_ranges = [file_range for file_range in await asyncio.to_thread(self.get_file_ranges, device_id) if
+                       file_range[2] >= past_timestamp]
+        result = await asyncio.to_thread(self.read_rows, file_ranges, columns, past_timestamp)
+        return downsampling.downsample(result, max_points, downsample_mode)
+
+    async def get_when_grid_last_on(self, device_id: str):
+        # Goes back through the files one at a time, newest first, and stops at the first one where the grid was on
+        for file_range in reversed(await asyncio.to_thread(self.get_file_ranges, device_id)):
+            result = await asyncio.to_thread(self.read_rows, [file_range], ["time_updated", "grid_state"])
+            on_times = [time_updated for time_updated, grid_state in
+                        zip(result.get("time_updated", ()), result.get("grid_state", ())) if grid_state == "on"]
+            if on_times:
+                return {'time_grid_last_on': on_times[-1]}
+
+        return None
+
+    async def summarise_data(self, device_id: str, cutoff_timestamp: int):
+        return {"success": False, "error": "CSV data is kept as it was logged, it can't be summarised"}
@@ -0,0 +1,197 @@
+import math
+
+DOWNSAMPLE_MODES = ("average", "minmax", "lttb")
+
+
+def validate_downsample_mode(mode: str):
+    if mode not in DOWNSAMPLE_MODES:
+        raise ValueError(f"Unknown downsampling mode '{mode}', expected one of {DOWNSAMPLE_MODES}")
+
+
+def get_num_buckets(max_points: int, mode: str) -> int:
+    # The min/max envelope gives two points per bucket, so it only gets half as many
+    return max(max_points // 2, 1) if mode == "minmax" else max_points
+
+
+def get_bucket_seconds(window_seconds: float, max_points: int, mode: str) -> float:
+    return window_seconds / get_num_buckets(max_points, mode)
+
+
+def is_numeric(values) -> bool:
+    return any(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values)
+
+
+def get_buckets(num_rows: int, num_buckets: int) -> list[range]:
+    # Splits the row indices into (almost) equally sized runs. The rows are in time order and the samples come in at a
+    # steady rate, so this is close enough to equal time buckets
+    return [range(i * num_rows // num_buckets, (i + 1) * num_rows // num_buckets) for i in range(num_buckets)]
+
+
+def mean(values) -> float:
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def downsample(result: dict, max_points: int, mode: str = "average") -> dict:
+    # Works on the column-wise dictionaries that the data interface returns, for results that didn't come out of the
+    # database already bucketed
+    validate_downsample_mode(mode)
+    num_rows = len(next(iter(result.values()), ()))
+    if max_points is None or num_rows <= max_points:
+        return result
+
+    if mode == "lttb":
+        return select_rows(result, largest_triangle_three_buckets(result, max_points))
+
+    numeric_keys = {key for key, values in result.items() if is_numeric(values)}
+    downsampled = {key: [] for key in result}
+
+    if mode == "minmax":
+        for bucket in get_buckets(num_rows, max(max_points // 2, 1)):
+            for aggregate, position in ((min, bucket.start), (max, bucket.stop - 1)):
+                for key, values in result.items():
+                    if key == "time_updated" or key not in numeric_keys:
+                        downsampled[key].append(values[position])
+                    else:
+                        downsampled[key].append(aggregate((values[i] for i in bucket if values[i] is not None),
+                                                          default=None))
+    else:
+        for bucket in get_buckets(num_rows, max_points):
+            for key, values in result.items():
+                if key in numeric_keys:
+                    downsampled[key].append(mean(values[i] for i in bucket))
+                else:
+                    downsampled[key].append(values[bucket.stop - 1])
+
+    return downsampled
+
+
+def select_rows(result: dict, indices: list[int]) -> dict:
+    return {key: [values[i] for i in indices] for key, values in result.items()}
+
+
+def largest_triangle_three_buckets(result: dict, max_points: int) -> list[int]:
+    # Steinarsson's LTTB, which keeps the shape of a line (peaks included) far better than averaging does. We have
+    # several series sharing one time axis, so each candidate is scored on its triangle area summed over all of the
+    # numeric columns, with each column scaled by its range so that no one series drowns out the rest
+    num_rows = len(next(iter(result.values())))
+    if max_points < 3:
+        return [0, num_rows - 1][:max_points]
+
+    x_values = result.get("time_updated") or range(num_rows)
+    y_columns = []
+    for key, values in result.items():
+        if key in ("id", "time_updated", "time_key") or not is_numeric(values):
+            continue
+
+        present_values = [value for value in values if value is not None]
+        value_range = (max(present_values) - min(present_values)) or 1.0
+        y_columns.append([(value if value is not None else 0.0) / value_range for value in values])
+
+    # The first and last rows are always kept, and everything in between is split into max_points - 2 buckets
+    buckets = [range(bucket.start + 1, bucket.stop + 1) for bucket in get_buckets(num_rows - 2, max_points - 2)]
+    selected = [0]
+    for i, bucket in enumerate(buckets):
+        next_bucket = buckets[i + 1] if i + 1 < len(buckets) else range(num_rows - 1, num_rows)
+        previous = selected[-1]
+        next_x = mean(x_values[j] for j in next_bucket)
+        next_ys = [mean(y_column[j] for j in next_bucket) for y_column in y_columns]
+
+        best_index, best_area = bucket.start, -1.0
+        for j in bucket:
+            area = 0.0
+            for y_column, next_y in zip(y_columns, next_ys):
+                area += abs((x_values[previous] - next_x) * (y_column[j] - y_column[previous]) -
+                            (x_values[previous] - x_values[j]) * (next_y - y_column[previous]))
+            if area > best_area:
+                best_index, best_area = j, area
+
+        selected.append(best_index)
+
+    selected.append(num_rows - 1)
+    return selected
+
+
+def get_held_value(result: dict, key: str, i: int, timestamp: float, is_line: bool):
+    # The value of row i's column at a time between it and the next row
+    value = result[key][i]
+    next_value = result[key][i + 1] if is_line else None
+    if value is None or next_value is None:
+        return value
+
+    time_updated, next_time = result["time_updated"][i], result["time_updated"][i + 1]
+    return value + (next_value - value) * (timestamp - time_updated) / (next_time - time_updated)
+
+
+def downsample_by_time(result: dict, start_timestamp: float, end_timestamp: float, max_points: int,
+                       mode: str = "average", interpolation: str = "step", max_gap: float = math.inf) -> dict:
+    # For compressed rows, which stand for every sample in between them. Each row's values hold until the next row (as
+    # steps), or run in a straight line to it (as lines), but never for longer than max_gap, since then the device
+    # wasn't reporting. The window is split into equal stretches of time, and each one is averaged over the time that
+    # each value held in it, so a value that held for a minute counts sixty times as much as one that held for a second
+    validate_downsample_mode(mode)
+    times = result.get("time_updated", ())
+    num_buckets = get_num_buckets(max_points, mode)
+    bucket_width = (end_timestamp - start_timestamp) / num_buckets
+    numeric_keys = [key for key, values in result.items() if
+                    key not in ("id", "time_updated", "time_key") and is_numeric(values)]
+
+    buckets = {}
+    for i, time_updated in enumerate(times):
+        next_time = times[i + 1] if i + 1 < len(times) else math.inf
+        held_until = min(next_time, time_updated + max_gap, end_timestamp)
+        is_line = interpolation == "linear" and i + 1 < len(times) and next_time - time_updated <= max_gap
+
+        segment_start = max(time_updated, start_timestamp)
+        if segment_start >= held_until:
+            continue
+
+        # Each part of the row's stretch that falls in a different bucket is added to that bucket
+        bucket_index = min(int((segment_start - start_timestamp) // bucket_width), num_buckets - 1)
+        while segment_start < held_until:
+            segment_end = held_until if bucket_index == num_buckets - 1 else \
+                min(held_until, start_timestamp + (bucket_index + 1) * bucket_width)
+            duration = segment_end - segment_start
+            bucket = buckets.setdefault(bucket_index, {"first_time": segment_start, "time_sum": 0.0, "duration": 0.0,
+                                                       "sums": {}, "durations": {}, "minima": {}, "maxima": {}})
+            bucket["last_time"] = segment_end
+            bucket["last_row"] = i
+            bucket["time_sum"] += (segment_start + segment_end) / 2 * duration
+            bucket["duration"] += duration
+            for key in numeric_keys:
+                start_value = get_held_value(result, key, i, segment_start, is_line)
+                end_value = get_held_value(result, key, i, segment_end, is_line)
+                if start_value is None:
+                    continue
+                # Along a straight line the mean is the value halfway, and the extremes are at the ends
+                bucket["sums"][key] = bucket["sums"].get(key, 0.0) + (start_value + end_value) / 2 * duration
+                bucket["durations"][key] = bucket["durations"].get(key, 0.0) + duration
+                bucket["minima"][key] = min(bucket["minima"].get(key, math.inf), start_value, end_value)
+                bucket["maxima"][key] = max(bucket["maxima"].get(key, -math.inf), start_value, end_value)
+
+            segment_start = segment_end
+            bucket_index += 1
+
+    downsampled = {key: [] for key in result}
+    for bucket_index in sorted(buckets):
+        bucket = buckets[bucket_index]
+        if mode == "minmax":
+            bucket_rows = [(bucket["first_time"], bucket["minima"]), (bucket["last_time"], bucket["maxima"])]
+        else:
+            averages = {key: bucket["sums"][key] / bucket["durations"][key] if bucket["durations"].get(key) else None
+                        for key in bucket["sums"]}
+            bucket_rows = [(bucket["time_sum"] / bucket["duration"], averages)]
+
+        for bucket_time, values in bucket_rows:
+            for key in result:
+                if key == "time_updated":
+                    downsampled[key].append(bucket_time)
+                elif key == "time_key":
+                    downsampled[key].append(int(bucket_time * 1000))
+                elif key in numeric_keys:
+                    downsampled[key].append(values.get(key))
+                else:
+                    # Anything that isn't a number takes the value that was holding at the end of the bucket
+                    downsampled[key].append(result[key][bucket["last_row"]])
+
+    return downsampled
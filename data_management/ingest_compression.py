@@ -0,0 +1,149 @@
+import math
+
+COMPRESSION_METHODS = ("deadband", "swinging_door")
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_compression_settings(ingest_compression: dict, rollup_tiers: list[int] = None):
+    # Summarising afterwards only has the stored rows to average, and a value that held for a minute would count no
+    # more than one that held for a second, so the summaries have to be written from every sample as they come in
+    if ingest_compression is not None and not rollup_tiers:
+        raise ValueError("Ingest compression needs streaming_rollups, otherwise the summaries are averaged from only "
+                         "the stored rows")
+
+
+class IngestCompressor:
+    # Decides which of a device's samples are worth storing. A sample is stored once any numeric column moves past its
+    # tolerance, any other column changes at all, or the heartbeat is due, so a flat signal costs one row per
+    # heartbeat rather than one per poll.
+    #
+    # With "deadband", a column has moved once it's further than its tolerance from the last stored value, and the
+    # stored rows are read back as steps. With "swinging_door", the stored rows are the corners of straight lines that
+    # pass within the tolerance of every sample in between, so they're read back as lines
+    def __init__(self, method: str = "deadband", tolerances: dict = None, default_tolerance: float = 0.0,
+                 heartbeat: float = 60.0, min_interval: float = 0.0):
+        if method not in COMPRESSION_METHODS:
+            raise ValueError(f"Unknown compression method '{method}', expected one of {COMPRESSION_METHODS}")
+
+        self.method = method
+        self.tolerances = tolerances or {}
+        self.default_tolerance = default_tolerance
+        self.heartbeat = heartbeat
+        self.min_interval = min_interval
+        self.last_stored = None
+        self.previous = None
+        # The swinging door's upper and lower slopes for each column, from the last stored sample
+        self.doors = {}
+
+    def get_tolerance(self, key: str) -> float:
+        return self.tolerances.get(key, self.default_tolerance)
+
+    def add(self, state_dictionary: dict) -> list[dict]:
+        # Returns the samples to store, oldest first
+        previous = self.previous
+        text_changed = previous is not None and any(
+            not is_number(value) and value != previous.get(key) for key, value in state_dictionary.items())
+
+        # Decimation: samples that come in faster than the minimum interval are dropped before anything else looks at
+        # them, unless they're the one where a state changed
+        if previous is not None and not text_changed and \
+                state_dictionary["time_updated"] - previous["time_updated"] < self.min_interval:
+            return []
+
+        self.previous = state_dictionary
+        if self.last_stored is None or state_dictionary.keys() != self.last_stored.keys() or text_changed or \
+                state_dictionary["time_updated"] - self.last_stored["time_updated"] >= self.heartbeat:
+            # A swinging door segment has to end on the last sample it covers, so that goes in first
+            held_rows = [previous] if self.method == "swinging_door" and previous is not None and \
+                previous is not self.last_stored else []
+            return [self.store(row) for row in held_rows + [state_dictionary]]
+
+        if self.method == "deadband":
+            return [self.store(state_dictionary)] if self.has_moved(state_dictionary) else []
+
+        return self.swing_doors(state_dictionary, previous)
+
+    def store(self, state_dictionary: dict) -> dict:
+        self.last_stored = state_dictionary
+        self.doors = {}
+        return state_dictionary
+
+    def has_moved(self, state_dictionary: dict) -> bool:
+        for key, value in state_dictionary.items():
+            if key == "time_updated" or not is_number(value):
+                continue
+
+            last_value = self.last_stored[key]
+            if last_value is None or abs(value - last_value) > self.get_tolerance(key):
+                return True
+
+        return False
+
+    def narrow_doors(self, state_dictionary: dict) -> dict:
+        # Returns the doors narrowed by this sample, or None if they've closed (no line from the last stored sample
+        # passes within the tolerance of every sample since)
+        elapsed = state_dictionary["time_updated"] - self.last_stored["time_updated"]
+        if elapsed <= 0:
+            return self.doors
+
+        doors = {}
+        for key, value in state_dictionary.items():
+            if key == "time_updated" or not is_number(value):
+                continue
+
+            anchor = self.last_stored[key]
+            if anchor is None:
+                return None
+
+            tolerance = self.get_tolerance(key)
+            upper, lower = self.doors.get(key, (math.inf, -math.inf))
+            upper = min(upper, (value + tolerance - anchor) / elapsed)
+            lower = max(lower, (value - tolerance - anchor) / elapsed)
+            if lower > upper:
+                return None
+
+            doors[key] = (upper, lower)
+
+        return doors
+
+    def swing_doors(self, state_dictionary: dict, previous: dict) -> list[dict]:
+        doors = self.narrow_doors(state_dictionary)
+        if doors is not None:
+            self.doors = doors
+            return []
+
+        # A column that's just started reporting closes the doors straight away, and there's nothing held to store
+        if previous is self.last_stored:
+            return [self.store(state_dictionary)]
+
+        # The previous sample was the last one the current line covers, so it's stored and the next line starts there.
+        # A single sample can never close the doors on its own, so this one just opens them again
+        stored_row = self.store(previous)
+        self.doors = self.narrow_doors(state_dictionary) or {}
+        return [stored_row]
+
+
+def reconstruct_steps(result: dict) -> dict:
+    # Deadband rows only record when something moved, so each value holds until the next row. Repeating the previous
+    # values at each row's time turns a line chart of the rows into the steps they stand for
+    if not result or "time_updated" not in result:
+        return result
+
+    keys = list(result)
+    rows = list(zip(*result.values()))
+    value_indices = [i for i, key in enumerate(keys) if key not in ("id", "time_updated", "time_key")]
+    time_indices = [i for i, key in enumerate(keys) if key in ("time_updated", "time_key")]
+
+    stepped_rows = rows[:1]
+    for previous_row, row in zip(rows, rows[1:]):
+        if any(previous_row[i] != row[i] for i in value_indices):
+            step_row = list(previous_row)
+            for i in time_indices:
+                step_row[i] = row[i]
+            stepped_rows.append(tuple(step_row))
+        stepped_rows.append(row)
+
+    return dict(zip(keys, zip(*stepped_rows)))
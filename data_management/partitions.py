@@ -0,0 +1,144 @@
+import asyncio
+import datetime
+import logging
+from time import time
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection
+
+log = logging.getLogger("Partitions")
+
+PARTITION_INTERVALS = ("daily", "monthly")
+PARTITION_NAME_FORMATS = {"daily": "%Y%m%d", "monthly": "%Y%m"}
+
+
+def get_partition_start(timestamp: float, interval: str) -> datetime.datetime:
+    # Partition boundaries are in UTC, so they don't move with daylight savings
+    start = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(hour=0, minute=0, second=0,
+                                                                                      microsecond=0)
+    if interval == "monthly":
+        start = start.replace(day=1)
+
+    return start
+
+
+def get_next_partition_start(start: datetime.datetime, interval: str) -> datetime.datetime:
+    if interval == "monthly":
+        return (start + datetime.timedelta(days=32)).replace(day=1)
+
+    return start + datetime.timedelta(days=1)
+
+
+def get_partition_name(table_name: str, start: datetime.datetime, interval: str) -> str:
+    return f"{table_name}_p{start.strftime(PARTITION_NAME_FORMATS[interval])}"
+
+
+def get_default_partition_name(table_name: str) -> str:
+    return f"{table_name}_default"
+
+
+def get_partition_bounds(partition_name: str, table_name: str, interval: str):
+    # Recovers the (start, end) timestamps of a partition from its name, or None if it isn't one of our partitions
+    suffix = partition_name[len(f"{table_name}_p"):]
+    try:
+        start = datetime.datetime.strptime(suffix, PARTITION_NAME_FORMATS[interval]).replace(
+            tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return None
+
+    return start.timestamp(), get_next_partition_start(start, interval).timestamp()
+
+
+def new_partition_expressions(table_name: str, timestamp: float, interval: str, partitions_ahead: int = 2):
+    # The default partition catches anything that falls outside the partitions we've made, so inserts never fail
+    expressions = [text(f'CREATE TABLE IF NOT EXISTS "{get_default_partition_name(table_name)}" '
+                        f'PARTITION OF "{table_name}" DEFAULT')]
+
+    start = get_partition_start(timestamp, interval)
+    for _ in range(partitions_ahead + 1):
+        end = get_next_partition_start(start, interval)
+        expressions.append(text(f'CREATE TABLE IF NOT EXISTS "{get_partition_name(table_name, start, interval)}" '
+                                f'PARTITION OF "{table_name}" FOR VALUES FROM ({start.timestamp()}) '
+                                f'TO ({end.timestamp()})'))
+        start = end
+
+    return expressions
+
+
+async def is_partitioned(connection: AsyncConnection, table_name: str) -> bool:
+    result = await connection.execute(text("SELECT relkind FROM pg_class WHERE relname = :table_name"),
+                                      {"table_name": table_name})
+    row = result.first()
+    return row is not None and row[0] == "p"
+
+
+async def get_partition_names(connection: AsyncConnection, table_name: str) -> list[str]:
+    result = await connection.execute(text(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid WHERE parent.relname = :table_name "
+        "ORDER BY child.relname"), {"table_name": table_name})
+    return [row[0] for row in result.fetchall()]
+
+
+async def remove_partitions_before(connection: AsyncConnection, table_name: str, timestamp: float, interval: str,
+                                   detach: bool = False) -> list[str]:
+    # Drops (or detaches, to archive elsewhere) every partition that ends at or before the timestamp. Either way this
+    # is a catalog change, rather than a DELETE that has to touch every row
+    removed_partitions = []
+    for partition_name in await get_partition_names(connection, table_name):
+        bounds = get_partition_bounds(partition_name, table_name, interval)
+        if bounds is None or bounds[1] > timestamp:
+            continue
+
+        if detach:
+            await connection.execute(text(f'ALTER TABLE "{table_name}" DETACH PARTITION "{partition_name}"'))
+        else:
+            await connection.execute(text(f'DROP TABLE "{partition_name}"'))
+        removed_partitions.append(partition_name)
+
+    if removed_partitions:
+        log.info(f"{'Detached' if detach else 'Dropped'} partitions of '{table_name}': {removed_partitions}")
+
+    return removed_partitions
+
+
+class PartitionManager:
+    def __init__(self, engine: AsyncEngine, table_names: list[str], interval: str = "daily",
+                 partitions_ahead: int = 2, check_interval: int = 3600):
+        if interval not in PARTITION_INTERVALS:
+            raise ValueError(f"Unknown partition interval '{interval}', expected one of {PARTITION_INTERVALS}")
+
+        self.engine = engine
+        self.table_names = table_names
+        self.interval = interval
+        self.partitions_ahead = partitions_ahead
+        self.check_interval = check_interval
+        self.running = True
+        self.stop_event = asyncio.Event()
+
+    async def run(self):
+        log.info(f"Starting {self.interval} partition manager...")
+        while self.running:
+            try:
+                await self.create_upcoming_partitions()
+            except Exception as e:
+                log.error(f"Failed to create upcoming partitions: {e}")
+
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def create_upcoming_partitions(self):
+        # Tables that don't exist yet get their first partitions from the SQL observer when it creates them
+        async with self.engine.begin() as connection:
+            for table_name in self.table_names:
+                if not await is_partitioned(connection, table_name):
+                    continue
+
+                for expression in new_partition_expressions(table_name, time(), self.interval,
+                                                            self.partitions_ahead):
+                    await connection.execute(expression)
+
+    async def stop(self):
+        self.running = False
+        self.stop_event.set()
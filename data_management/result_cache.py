@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+from collections import OrderedDict
+from time import monotonic, time
+from data_management.data_interface import DataInterface, STREAM_CHUNK_SIZE
+from data_management.ring_buffer import DeviceRingBuffer
+
+
+class CacheEntry:
+    def __init__(self, device_id: str, value, expires: float, window_seconds: float = None,
+                 columns: list[str] = None, keep_until_expiry: bool = False):
+        self.device_id = device_id
+        self.value = value
+        self.expires = expires
+        # Only set for raw windows with explicit columns, which new samples can be appended to as they arrive
+        self.window_seconds = window_seconds
+        self.columns = columns
+        self.keep_until_expiry = keep_until_expiry
+
+
+class CachedDataInterface(DataInterface):
+    # Sits in front of another data interface, so that the dashboard tabs and scripts that all ask for the same
+    # windows share one query between them
+    def __init__(self, data_interface: DataInterface, max_entries: int = 256, ttl: float = 5.0):
+        self.data_interface = data_interface
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.statistics = {"hits": 0, "misses": 0, "shared": 0, "extended": 0, "invalidated": 0, "evicted": 0}
+
+    async def get_cached(self, key: tuple, device_id: str, load: callable, window_seconds: float = None,
+                         columns: list[str] = None, keep_until_expiry: bool = False):
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires > monotonic():
+            self.statistics["hits"] += 1
+            self.entries.move_to_end(key)
+            if entry.window_seconds is not None:
+                entry.value = trim_result(entry.value, time() - entry.window_seconds)
+            return entry.value
+
+        # Identical requests that arrive while the first one is still running wait on its query instead of their own
+        if key in self.in_flight:
+            self.statistics["shared"] += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        self.statistics["misses"] += 1
+        future = asyncio.ensure_future(load())
+        self.in_flight[key] = future
+        future.add_done_callback(lambda f: self.finish_load(key, device_id, f, window_seconds, columns,
+                                                            keep_until_expiry))
+        # Shielded, so one caller giving up doesn't cancel the query for everyone else waiting on it
+        return await asyncio.shield(future)
+
+    def finish_load(self, key: tuple, device_id: str, future: asyncio.Future, window_seconds: float = None,
+                    columns: list[str] = None, keep_until_expiry: bool = False):
+        del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self.entries[key] = CacheEntry(device_id, future.result(), monotonic() + self.ttl, window_seconds, columns,
+                                       keep_until_expiry)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.statistics["evicted"] += 1
+
+    def add_sample(self, device_id: str, state_dictionary: dict):
+        # Raw windows get the new sample appended (and their oldest rows trimmed), so they stay correct without going
+        # back to the database. Downsampled results barely move with one more sample, so they're left to expire, and
+        # anything else for the device is dropped
+        if state_dictionary is None:
+            return
+
+        for key, entry in list(self.entries.items()):
+            if entry.device_id != device_id:
+                continue
+
+            if key[0] == "grid_last_on":
+                if state_dictionary.get("grid_state") == "on":
+                    entry.value = {"time_grid_last_on": state_dictionary["time_updated"]}
+                    self.statistics["extended"] += 1
+            elif entry.window_seconds is not None and all(column in state_dictionary for column in entry.columns):
+                entry.value = extend_result(entry.value, state_dictionary, entry.columns,
+                                            time() - entry.window_seconds)
+                self.statistics["extended"] += 1
+            elif entry.keep_until_expiry:
+                continue
+            else:
+                del self.entries[key]
+                self.statistics["invalidated"] += 1
+
+    def invalidate_device(self, device_id: str):
+        for key in [key for key, entry in self.entries.items() if entry.device_id == device_id]:
+            del self.entries[key]
+            self.statistics["invalidated"] += 1
+
+    def get_cache_statistics(self) -> dict:
+        lookups = self.statistics["hits"] + self.statistics["misses"] + self.statistics["shared"]
+        return {**self.statistics, "entries": len(self.entries), "in_flight": len(self.in_flight),
+                "hit_rate": (self.statistics["hits"] + self.statistics["shared"]) / lookups if lookups else None}
+
+    async def get_last_n_entries(self, device_id: str, n: int, columns: list[str] = None):
+        return await self.data_interface.get_last_n_entries(device_id, n, columns)
+
+    async def get_entries_page(self, device_id: str, page_size: int, columns: list[str] = None, order: str = "desc",
+                               page_token: str = None) -> tuple[dict, str]:
+        # Pages are read once each by exporters, so there's nothing to gain from caching them
+        return await self.data_interface.get_entries_page(device_id, page_size, columns, order, page_token)
+
+    async def get_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None, max_points: int = None,
+                                 downsample_mode: str = "average", history: DeviceRingBuffer = None):
+        key = ("past_minutes", device_id, n, tuple(columns) if columns else None, max_points, downsample_mode)
+        extendable = max_points is None and columns is not None and "time_updated" in columns
+        return await self.get_cached(
+            key, device_id,
+            lambda: self.data_interface.get_last_n_minutes(device_id, n, columns, max_points, downsample_mode,
+                                                           history),
+            n * 60 if extendable else None, columns, max_points is not None)
+
+    def stream_last_n_minutes(self, device_id: str, n: int, columns: list[str] = None,
+                              chunk_size: int = STREAM_CHUNK_SIZE):
+        # Streams are for windows too big to hold in memory, so they're never cached
+        return self.data_interface.stream_last_n_minutes(device_id, n, columns, chunk_size)
+
+    async def get_when_grid_last_on(self, device_id: str):
+        return await self.get_cached(("grid_last_on", device_id), device_id,
+                                     lambda: self.data_interface.get_when_grid_last_on(device_id))
+
+    async def get_range_aggregates(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                   bucket_seconds: float, columns: list[str] = None, aggregates: list[str] = None):
+        return await self.data_interface.get_range_aggregates(device_id, start_timestamp, end_timestamp,
+                                                              bucket_seconds, columns, aggregates)
+
+    async def get_archived_range(self, device_id: str, start_timestamp: float, end_timestamp: float,
+                                 columns: list[str] = None, table: str = "raw", max_points: int = None,
+                                 downsample_mode: str = "average"):
+        # Archived periods never change, and the files are read straight from disk, so caching gains little here
+        return await self.data_interface.get_archived_range(device_id, start_timestamp, end_timestamp, columns,
+                                                            table, max_points, downsample_mode)
+
+    async def get_grid_outages(self, device_id: str, days: float):
+        return await self.data_interface.get_grid_outages(device_id, days)
+
+    async def get_daily_outage_totals(self, device_id: str, days: int):
+        return await self.data_interface.get_daily_outage_totals(device_id, days)
+
+    async def summarise_data(self, device_id: str, cutoff_timestamp: int):
+        result = await self.data_interface.summarise_data(device_id, cutoff_timestamp)
+        self.invalidate_device(device_id)
+        return result
+
+
+def trim_result(result: dict, cutoff_timestamp: float) -> dict:
+    if not result:
+        return result
+
+    first = bisect.bisect_left(result["time_updated"], cutoff_timestamp)
+    if first == 0:
+        return result
+
+    # A new dictionary rather than trimming in place, since an earlier caller might still be encoding the old one
+    return {key: values[first:] for key, values in result.items()}
+
+
+def extend_result(result: dict, state_dictionary: dict, columns: list[str], cutoff_timestamp: float) -> dict:
+    if result and state_dictionary["time_updated"] <= result["time_updated"][-1]:
+        return result
+
+    extended_result = {column: list(result.get(column, ())) + [state_dictionary[column]] for column in columns}
+    return trim_result(extended_result, cutoff_timestamp)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from time import time
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from data_management import sql_utilities, partitions
+
+log = logging.getLogger("Retention")
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_CHUNK_PAUSE = 0.1  # seconds
+
+
+async def delete_in_chunks(engine: AsyncEngine, table_name: str, cutoff_timestamp: float,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_pause: float = DEFAULT_CHUNK_PAUSE) -> int:
+    # Each chunk is its own short transaction, with a pause in between, so ingest never waits on one huge DELETE
+    quoted_name = engine.dialect.identifier_preparer.quote(table_name)
+    query = text(f"DELETE FROM {quoted_name} WHERE id IN (SELECT id FROM {quoted_name} "
+                 f"WHERE time_updated <= :cutoff_timestamp LIMIT :chunk_size)")
+
+    total_deleted = 0
+    while True:
+        async with engine.begin() as connection:
+            result = await connection.execute(query, {"cutoff_timestamp": cutoff_timestamp, "chunk_size": chunk_size})
+
+        total_deleted += result.rowcount
+        if result.rowcount < chunk_size:
+            return total_deleted
+
+        await asyncio.sleep(chunk_pause)
+
+
+async def get_summarised_until(connection, summary_name: str):
+    # The end of the latest summarised minute. Raw rows up to it are in the summary, and anything after it is only
+    # in the raw table, so that's as far as raw rows can ever be deleted
+    quoted_name = connection.dialect.identifier_preparer.quote(summary_name)
+    return (await connection.execute(text(f"SELECT max(time_updated) FROM {quoted_name}"))).scalar()
+
+
+async def vacuum_table(engine: AsyncEngine, table_name: str):
+    async with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            # VACUUM can't run inside a transaction block
+            connection = await connection.execution_options(isolation_level="AUTOCOMMIT")
+            quoted_name = engine.dialect.identifier_preparer.quote(table_name)
+            await connection.execute(text(f"VACUUM (ANALYZE) {quoted_name}"))
+        elif engine.dialect.name == "sqlite":
+            # This only gives pages back when the database was created with auto_vacuum=INCREMENTAL
+            await connection.execute(text("PRAGMA incremental_vacuum"))
+            await connection.execute(text("PRAGMA optimize"))
+            await connection.commit()
+
+
+class RetentionEnforcer:
+    def __init__(self, engine: AsyncEngine, device_ids: list[str], *, raw_days: float = None,
+                 rollup_days: dict[int, float] = None, partition_interval: str = None, detach_expired: bool = False,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_pause: float = DEFAULT_CHUNK_PAUSE,
+                 check_interval: int = 3600, vacuum: bool = True):
+        self.engine = engine
+        self.device_ids = device_ids
+        self.partition_interval = partition_interval
+        self.detach_expired = detach_expired
+        self.chunk_size = chunk_size
+        self.chunk_pause = chunk_pause
+        self.check_interval = check_interval
+        self.vacuum = vacuum
+        self.running = True
+        self.stop_event = asyncio.Event()
+
+        # Retention periods in days, per table. Anything without a period is kept forever
+        self.retention_periods = {}
+        self.summary_names = {}
+        for device_id in device_ids:
+            if raw_days is not None:
+                self.retention_periods[sql_utilities.get_table_name(device_id)] = raw_days
+                self.summary_names[sql_utilities.get_table_name(device_id)] = sql_utilities.get_summary_name(device_id)
+            for bucket_seconds, days in (rollup_days or {}).items():
+                if days is not None:
+                    self.retention_periods[sql_utilities.get_rollup_name(device_id, int(bucket_seconds))] = days
+
+    async def run(self):
+        log.info(f"Starting retention enforcement for {len(self.retention_periods)} tables...")
+        while self.running:
+            try:
+                await self.enforce()
+            except Exception as e:
+                log.error(f"Failed to enforce retention: {e}")
+
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), self.check_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def enforce(self):
+        for table_name, days in self.retention_periods.items():
+            if not self.running:
+                return
+
+            if not await self.table_exists(table_name):
+                continue
+
+            cutoff_timestamp = time() - days * 24 * 60 * 60
+            if table_name in self.summary_names:
+                cutoff_timestamp = await self.get_raw_cutoff(table_name, cutoff_timestamp)
+                if cutoff_timestamp is None:
+                    continue
+
+            removed_partitions = await self.remove_expired_partitions(table_name, cutoff_timestamp)
+            num_deleted = await delete_in_chunks(self.engine, table_name, cutoff_timestamp, self.chunk_size,
+                                                 self.chunk_pause)
+
+            if num_deleted > 0:
+                log.info(f"Deleted {num_deleted} expired rows from '{table_name}'")
+            if self.vacuum and (num_deleted > 0 or removed_partitions):
+                await vacuum_table(self.engine, table_name)
+
+    async def table_exists(self, table_name: str) -> bool:
+        async with self.engine.connect() as connection:
+            return await connection.run_sync(lambda sync_connection: self.engine.dialect.has_table(sync_connection,
+                                                                                                   table_name))
+
+    async def get_raw_cutoff(self, table_name: str, cutoff_timestamp: float):
+        # Raw rows are only deleted once they're in the summary, so if summarising is behind (or isn't happening at
+        # all) they're kept until it catches up, however old they are
+        summary_name = self.summary_names[table_name]
+        if not await self.table_exists(summary_name):
+            return None
+
+        async with self.engine.connect() as connection:
+            summarised_until = await get_summarised_until(connection, summary_name)
+
+        if summarised_until is None:
+            return None
+        if summarised_until < cutoff_timestamp:
+            log.warning(f"Keeping the expired rows of '{table_name}' after {summarised_until}, since they haven't "
+                        f"been summarised yet")
+            return summarised_until
+
+        return cutoff_timestamp
+
+    async def remove_expired_partitions(self, table_name: str, cutoff_timestamp: float) -> list[str]:
+        if not self.partition_interval or self.engine.dialect.name != "postgresql":
+            return []
+
+        async with self.engine.begin() as connection:
+            if not await partitions.is_partitioned(connection, table_name):
+                return []
+
+            return await partitions.remove_partitions_before(connection, table_name, cutoff_timestamp,
+                                                             self.partition_interval, self.detach_expired)
+
+    async def stop(self):
+        self.running = False
+        self.stop_event.set()
@@ -0,0 +1,84 @@
+from array import array
+
+
+class DeviceRingBuffer:
+    # A fixed number of the most recent samples from one device, kept column-wise. Numeric columns are typed arrays,
+    # so a full buffer is a handful of flat blocks of doubles rather than thousands of dictionaries
+    def __init__(self, capacity: int = 3600):
+        if capacity < 1:
+            raise ValueError("The ring buffer capacity has to be at least 1")
+
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+        self.columns = {}
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+        self.columns = {}
+
+    def make_columns(self, state_dictionary: dict):
+        self.clear()
+        for key, value in state_dictionary.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.columns[key] = array("d", bytes(8 * self.capacity))
+            else:
+                self.columns[key] = [None] * self.capacity
+
+    def append(self, state_dictionary: dict):
+        # Samples have to arrive in time order, and the receive loop can hand us the same state more than once
+        if self.size > 0 and state_dictionary["time_updated"] <= self.get_timestamp(self.size - 1):
+            return
+
+        # A device that starts reporting different fields (a battery module coming online, say) starts a new buffer,
+        # since every column has to cover the same samples
+        if state_dictionary.keys() != self.columns.keys():
+            self.make_columns(state_dictionary)
+
+        position = (self.start + self.size) % self.capacity
+        for key, value in state_dictionary.items():
+            self.columns[key][position] = value
+
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def get_timestamp(self, index: int) -> float:
+        return self.columns["time_updated"][(self.start + index) % self.capacity]
+
+    def get_oldest_timestamp(self):
+        return self.get_timestamp(0) if self.size > 0 else None
+
+    def has_columns(self, columns: list[str]) -> bool:
+        return all(column in self.columns for column in columns)
+
+    def find(self, timestamp: float) -> int:
+        # Index of the first sample at or after the timestamp, counting from the oldest sample
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def get_since(self, timestamp: float, columns: list[str] = None) -> dict:
+        first = self.find(timestamp)
+        if first == self.size:
+            return {}
+
+        # The samples we want are at most two contiguous runs of each column, either side of the wrap-around
+        begin = (self.start + first) % self.capacity
+        end = (self.start + self.size) % self.capacity or self.capacity
+        runs = [(begin, end)] if begin < end else [(begin, self.capacity), (0, end)]
+
+        result = {}
+        for key in columns or self.columns:
+            column = self.columns[key]
+            result[key] = [value for run_start, run_end in runs for value in column[run_start:run_end]]
+
+        return result
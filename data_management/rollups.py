@@ -0,0 +1,133 @@
+import math
+
+
+class RunningStatistics:
+    # Welford's online algorithm, so we never have to hold on to the samples themselves
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squares = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.sum_of_squares += delta * (value - self.mean)
+
+    def merge(self, other: "RunningStatistics"):
+        # Chan et al.'s parallel combination, which lets a coarser tier be built from the finished buckets below it
+        if other.count == 0:
+            return
+
+        total_count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total_count
+        self.sum_of_squares += other.sum_of_squares + delta ** 2 * self.count * other.count / total_count
+        self.count = total_count
+
+    def standard_deviation(self):
+        # Sample standard deviation, to match what stddev() gives us in the database
+        if self.count < 2:
+            return None
+
+        return math.sqrt(self.sum_of_squares / (self.count - 1))
+
+
+class BucketRollup:
+    def __init__(self, bucket_seconds: int = 60):
+        self.bucket_seconds = bucket_seconds
+        self.bucket_end = None
+        self.statistics = {}
+        self.last_values = {}
+
+    def get_bucket_end(self, timestamp: float) -> int:
+        # Buckets are labelled by the time they end, the same as the summary tables, and a sample right on a boundary
+        # belongs to the bucket that ends there
+        return math.ceil(timestamp / self.bucket_seconds) * self.bucket_seconds
+
+    def add(self, state_dictionary: dict):
+        # Returns the previous bucket as (bucket end, statistics, last values) once a sample from a new bucket arrives
+        finished_bucket = self.roll_over(state_dictionary["time_updated"])
+
+        for key, value in state_dictionary.items():
+            if key == "time_updated":
+                continue
+
+            if isinstance(value, float):
+                self.statistics.setdefault(key, RunningStatistics()).add(value)
+            else:
+                self.last_values[key] = value
+
+        return finished_bucket
+
+    def add_bucket(self, bucket_end: float, statistics: dict, last_values: dict):
+        finished_bucket = self.roll_over(bucket_end)
+
+        for key, key_statistics in statistics.items():
+            self.statistics.setdefault(key, RunningStatistics()).merge(key_statistics)
+        self.last_values.update(last_values)
+
+        return finished_bucket
+
+    def finish(self):
+        # Closes the current bucket early, for when we know that no more samples are coming
+        if self.bucket_end is None:
+            return None
+
+        finished_bucket = (self.bucket_end, self.statistics, self.last_values)
+        self.bucket_end = None
+        self.statistics = {}
+        self.last_values = {}
+        return finished_bucket
+
+    def roll_over(self, timestamp: float):
+        bucket_end = self.get_bucket_end(timestamp)
+
+        finished_bucket = None
+        if self.bucket_end is not None and bucket_end != self.bucket_end:
+            finished_bucket = (self.bucket_end, self.statistics, self.last_values)
+            self.statistics = {}
+            self.last_values = {}
+        self.bucket_end = bucket_end
+
+        return finished_bucket
+
+
+class TieredRollup:
+    def __init__(self, bucket_sizes: list[int]):
+        bucket_sizes = sorted(bucket_sizes)
+        for smaller, larger in zip(bucket_sizes, bucket_sizes[1:]):
+            if larger % smaller != 0:
+                raise ValueError(f"Rollup tier of {larger}s is not a multiple of the {smaller}s tier below it")
+
+        self.rollups = [BucketRollup(bucket_size) for bucket_size in bucket_sizes]
+
+    def add(self, state_dictionary: dict) -> list[tuple[int, dict]]:
+        # Samples only go into the finest tier. Every bucket that closes is passed up to the tier above it, so each
+        # tier is built from the one below without ever rescanning anything
+        finished_rows = []
+        finished_bucket = self.rollups[0].add(state_dictionary)
+
+        for i, rollup in enumerate(self.rollups):
+            if finished_bucket is None:
+                break
+
+            finished_rows.append((rollup.bucket_seconds, get_bucket_row(finished_bucket)))
+
+            if i + 1 < len(self.rollups):
+                bucket_end, statistics, last_values = finished_bucket
+                finished_bucket = self.rollups[i + 1].add_bucket(bucket_end, statistics, last_values)
+
+        return finished_rows
+
+
+def get_bucket_row(finished_bucket: tuple) -> dict:
+    bucket_end, statistics, last_values = finished_bucket
+
+    row = {"time_updated": bucket_end}
+    for key, key_statistics in statistics.items():
+        row[key] = key_statistics.mean
+        row[f"{key}_stdev"] = key_statistics.standard_deviation()
+    row.update(last_values)
+
+    return row
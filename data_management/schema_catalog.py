@@ -0,0 +1,54 @@
+import logging
+from sqlalchemy import MetaData, Table, inspect
+
+log = logging.getLogger("Schema catalog")
+
+
+class SchemaCatalog:
+    # One catalog per database, shared by the ingest session and the data interface
+    _catalogs = {}
+
+    @classmethod
+    def for_connection_string(cls, sql_connection_string: str) -> "SchemaCatalog":
+        if sql_connection_string not in cls._catalogs:
+            cls._catalogs[sql_connection_string] = cls()
+
+        return cls._catalogs[sql_connection_string]
+
+    def __init__(self):
+        self.metadata = MetaData()
+        # Bumped whenever the schema we know about changes, so anything derived from it knows to rebuild
+        self.version = 0
+        # Tables that are defined in our metadata, but whose CREATE hasn't been committed yet
+        self.pending_tables = set()
+
+    async def load(self, connection, table_names: list[str]):
+        # Only reflects the tables (and views) we're asked about that exist and that we don't know about yet, so this
+        # doesn't get slower as the rest of the database grows
+        def reflect_missing_tables(sync_connection):
+            inspector = inspect(sync_connection)
+            missing_tables = [table_name for table_name in table_names if table_name not in self.metadata.tables
+                              and inspector.has_table(table_name)]
+            if missing_tables:
+                log.info(f"Reflecting {missing_tables}...")
+                self.metadata.reflect(sync_connection, only=missing_tables, views=True)
+
+            return missing_tables
+
+        if await connection.run_sync(reflect_missing_tables):
+            self.version += 1
+
+    def has_table(self, table_name: str) -> bool:
+        return table_name in self.metadata.tables and table_name not in self.pending_tables
+
+    def add_pending_table(self, table_name: str):
+        self.pending_tables.add(table_name)
+
+    def get_table(self, table_name: str) -> Table:
+        return self.metadata.tables[table_name]
+
+    def record_ddl(self, created_table_names: list[str]):
+        # Called once DDL has been committed. New tables are defined in our metadata before they're created, so all we
+        # need to do is stop treating them as pending and let everyone know
+        self.pending_tables.difference_update(created_table_names)
+        self.version += 1
@@ -0,0 +1,133 @@
+import logging
+import os
+import threading
+import time
+import msgpack
+
+log = logging.getLogger("Spool")
+
+SEGMENT_SUFFIX = ".spool"
+OFFSET_SUFFIX = ".offset"
+DEAD_LETTER_FILENAME = "dead_letters"
+
+
+class WriteAheadSpool:
+    # An append-only spool of (table name, row) records on disk, for while the database can't be reached. Records are
+    # msgpack values written one after another into numbered segment files, so the oldest segment is always the one
+    # with the lowest number, and a record cut off by a crash is simply where that segment ends.
+    #
+    # None of this is async, the session runs it in threads, hence the lock around the active segment
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, fsync_interval: float = 1.0):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.active_file = None
+        self.active_path = None
+        self.last_fsync = 0.0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def get_segments(self) -> list[str]:
+        return sorted(os.path.join(self.directory, filename) for filename in os.listdir(self.directory)
+                      if filename.endswith(SEGMENT_SUFFIX))
+
+    def has_records(self) -> bool:
+        return len(self.get_segments()) > 0
+
+    def append(self, records: list[tuple[str, dict]]):
+        with self.lock:
+            self.append_records(records)
+
+    def append_records(self, records: list[tuple[str, dict]]):
+        if self.active_file is None:
+            # Nanoseconds, zero-padded, so that the segments sort by age however many there are
+            self.active_path = os.path.join(self.directory, f"{time.time_ns():020d}{SEGMENT_SUFFIX}")
+            self.active_file = open(self.active_path, "ab")
+
+        self.active_file.write(b"".join(msgpack.packb(list(record), use_bin_type=True) for record in records))
+
+        # Syncing every append would wear out an SD card, so a crash can lose at most the last fsync interval
+        if time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.sync()
+
+        if self.active_file.tell() >= self.segment_bytes:
+            self.close_active_segment()
+
+    def sync(self):
+        if self.active_file is None:
+            return
+
+        self.active_file.flush()
+        os.fsync(self.active_file.fileno())
+        self.last_fsync = time.monotonic()
+
+    def close_segment(self):
+        with self.lock:
+            self.close_active_segment()
+
+    def close_active_segment(self):
+        # Only closed segments are replayed, so new records never land in a segment that's being read
+        if self.active_file is None:
+            return
+
+        self.sync()
+        self.active_file.close()
+        self.active_file = None
+        self.active_path = None
+
+    def get_oldest_closed_segment(self):
+        with self.lock:
+            segments = [segment for segment in self.get_segments() if segment != self.active_path]
+            if not segments and self.active_path is not None:
+                self.close_active_segment()
+                segments = self.get_segments()
+
+            return segments[0] if segments else None
+
+    def read_segment(self, segment: str, batch_size: int):
+        # Yields lists of records along with the offset just past them, starting from wherever replay got to before
+        with open(segment, "rb") as segment_file:
+            segment_file.seek(self.get_replayed_offset(segment))
+            unpacker = msgpack.Unpacker(segment_file, raw=False)
+            start_offset = segment_file.tell()
+
+            records = []
+            for table_name, row in unpacker:
+                records.append((table_name, row))
+                if len(records) >= batch_size:
+                    yield records, start_offset + unpacker.tell()
+                    records = []
+
+            if records:
+                yield records, start_offset + unpacker.tell()
+
+    def get_replayed_offset(self, segment: str) -> int:
+        try:
+            with open(segment + OFFSET_SUFFIX) as offset_file:
+                return int(offset_file.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def mark_replayed(self, segment: str, offset: int):
+        # Written after each replayed batch commits, so a replay that's interrupted never inserts anything twice
+        temporary_path = f"{segment}{OFFSET_SUFFIX}.tmp"
+        with open(temporary_path, "w") as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.replace(temporary_path, segment + OFFSET_SUFFIX)
+
+    def remove_segment(self, segment: str):
+        os.remove(segment)
+        if os.path.exists(segment + OFFSET_SUFFIX):
+            os.remove(segment + OFFSET_SUFFIX)
+        log.info(f"Finished replaying spool segment '{segment}'")
+
+    def add_dead_letters(self, records: list[tuple[str, dict]]):
+        # Records the database will never take, kept in the same format as the segments for someone to look at. The
+        # name doesn't end in the segment suffix, so they're never replayed
+        with open(os.path.join(self.directory, DEAD_LETTER_FILENAME), "ab") as dead_letter_file:
+            dead_letter_file.write(b"".join(msgpack.packb(list(record), use_bin_type=True) for record in records))
+            dead_letter_file.flush()
+            os.fsync(dead_letter_file.fileno())
@@ -1,3 +1,21 @@
+import base64
+import json
+import logging
+import re
+from collections import OrderedDict
+from sqlalchemy import Table, Column, BigInteger, Float, Integer, Index, MetaData, insert, text, event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+log = logging.getLogger("SQL utilities")
+
+SQLITE_PROFILE_PRAGMAS = ("synchronous", "mmap_size", "cache_size", "temp_store", "wal_autocheckpoint")
+POOL_SETTINGS = ("pool_size", "max_overflow", "pool_timeout", "pool_recycle", "statement_timeout")
+
+# Engines are shared by everything in the process that asks for the same database with the same pool settings
+_engines = {}
+
+
 def get_table_name(device_id: str):
     return f"device_{device_id}"
 
@@ -10,10 +28,58 @@ def get_view_name(device_id: str):
     return f"view_{device_id}"
 
 
+def get_rollup_name(device_id: str, bucket_seconds: int):
+    # The per-minute tier is the original summary table
+    if bucket_seconds == 60:
+        return get_summary_name(device_id)
+
+    return f"rollup_{bucket_seconds}_{device_id}"
+
+
+def get_outage_table_name(device_id: str):
+    return f"outages_{device_id}"
+
+
+def get_device_table_names(device_id: str, rollup_tiers: list[int] = None) -> list[str]:
+    table_names = [get_table_name(device_id), get_summary_name(device_id), get_view_name(device_id)]
+    table_names += [get_rollup_name(device_id, bucket_seconds) for bucket_seconds in rollup_tiers or [] if
+                    bucket_seconds != 60]
+    return table_names
+
+
+def get_time_key(timestamp: float) -> int:
+    # Integer epoch milliseconds, which are cheaper to index and bucket than float seconds
+    return int(timestamp * 1000)
+
+
+def is_time_series_table(table_name: str) -> bool:
+    return table_name.startswith(("device_", "summary_", "rollup_"))
+
+
+def get_rollup_tiers(sql_config: dict):
+    # Rollup tiers only exist when the daemon is writing streaming rollups
+    if not sql_config.get("streaming_rollups", False):
+        return None
+
+    rollup_tiers = sorted(sql_config.get("rollup_tiers", [60]))
+    if 60 not in rollup_tiers:
+        raise ValueError("Rollup tiers must include the 60 second summary tier")
+
+    return rollup_tiers
+
+
 def get_sql_connection_string(sql_driver: str, database_path: str):
     return f'{sql_driver}://{database_path}'
 
 
+def get_read_connection_string(sql_config: dict):
+    # Queries can go to a read-only replica, which uses the same driver as the main database
+    if "read_database_path" not in sql_config:
+        return None
+
+    return get_sql_connection_string(sql_config["sql_driver"], sql_config["read_database_path"])
+
+
 def get_selection_columns(columns: list[str] = None):
     if columns:
         return ", ".join(columns)
@@ -21,6 +87,32 @@ def get_selection_columns(columns: list[str] = None):
         return "*"
 
 
+def encode_page_token(order: str, time_value, row_id: int) -> str:
+    # Opaque to clients, but it's only the position of the last row they've seen, so there's nothing to keep secret
+    return base64.urlsafe_b64encode(json.dumps([order, time_value, row_id]).encode()).decode()
+
+
+def decode_page_token(page_token: str, order: str) -> tuple:
+    try:
+        token_order, time_value, row_id = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid page token")
+
+    if token_order != order:
+        raise ValueError("The page token is for the other order")
+
+    return time_value, row_id
+
+
+def concatenate_results(results: list[dict]) -> dict:
+    concatenated_results = {}
+    for result in results:
+        for key, values in result.items():
+            concatenated_results.setdefault(key, []).extend(values)
+
+    return concatenated_results
+
+
 def convert_cursor_result_to_dict(result) -> list[dict]:
     all_results = result.fetchall()
     transposed_results = list(zip(*all_results))
@@ -33,3 +125,151 @@ def convert_cursor_result_to_dict(result) -> list[dict]:
         return_dict[key] = transposed_results[i]
 
     return return_dict
+
+
+class StatementCache:
+    # Bounded cache of statements keyed on (kind, device, columns). Reusing the exact same statement keeps the SQL
+    # string stable, so SQLAlchemy's compiled cache and the driver's prepared statement cache both get hits
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.statements = OrderedDict()
+
+    def get(self, key: tuple, build_statement: callable):
+        if key in self.statements:
+            self.statements.move_to_end(key)
+            return self.statements[key]
+
+        statement = build_statement()
+        self.statements[key] = statement
+        if len(self.statements) > self.max_size:
+            self.statements.popitem(last=False)
+
+        return statement
+
+    def clear(self):
+        self.statements.clear()
+
+
+def compile_insert(table: Table, column_keys: list[str], dialect) -> tuple[str, list[str]]:
+    # Compiles an executemany insert down to the driver's SQL, along with its parameter names. With a positional
+    # paramstyle they're in the order the driver expects, otherwise the parameters are matched by name
+    compiled = insert(table).compile(dialect=dialect, column_keys=column_keys, for_executemany=True)
+    return str(compiled), list(compiled.positiontup if compiled.positional else compiled.params)
+
+
+def get_insert_parameters(rows: list[dict], parameter_names: list[str], dialect) -> list:
+    if dialect.positional:
+        return [tuple(row[name] for name in parameter_names) for row in rows]
+
+    return [{name: row[name] for name in parameter_names} for row in rows]
+
+
+def time_indexes(table: Table, dialect_name: str = None) -> list[Index]:
+    # A B-tree index for the range scans and ordering, plus a tiny BRIN index on Postgres since these tables are
+    # append-only and naturally ordered by time. Building an Index attaches it to the table, so any the table already
+    # has are left out
+    index_specs = [(f"ix_{table.name}_time_updated", "time_updated", {})]
+    if dialect_name == "postgresql":
+        index_specs.append((f"brin_{table.name}_time_updated", "time_updated", {"postgresql_using": "brin"}))
+    if "time_key" in table.c:
+        index_specs.append((f"ix_{table.name}_time_key", "time_key", {}))
+
+    existing_index_names = {index.name for index in table.indexes}
+    return [Index(name, table.c[column_name], **kwargs) for name, column_name, kwargs in index_specs if
+            name not in existing_index_names]
+
+
+def new_outage_table(metadata: MetaData, table_name: str) -> Table:
+    # One row per stretch of time without grid power. last_on is the last sample that had the grid on before it went
+    # off, and ended stays NULL for as long as the outage is still going
+    table = Table(table_name, metadata,
+                  Column("id", Integer, primary_key=True, autoincrement=True),
+                  Column("last_on", Float),
+                  Column("started", Float, nullable=False),
+                  Column("ended", Float))
+    Index(f"ix_{table_name}_started", table.c.started)
+    return table
+
+
+def migrate_time_columns(connection, metadata: MetaData, epoch_millisecond_keys: bool = False):
+    # Brings tables created before the time indexes (and optional time keys) existed up to date
+    preparer = connection.dialect.identifier_preparer
+    for table in list(metadata.tables.values()):
+        if not is_time_series_table(table.name) or "time_updated" not in table.c:
+            continue
+
+        if epoch_millisecond_keys and "time_key" not in table.c:
+            log.info(f"Adding time key column to '{table.name}'...")
+            quoted_name = preparer.format_table(table)
+            connection.execute(text(f"ALTER TABLE {quoted_name} ADD COLUMN time_key BIGINT"))
+            # Keys are truncated, the same as get_time_key does. Postgres rounds when casting, so it has to floor
+            # first, while SQLite's cast already truncates (and it doesn't always have FLOOR)
+            time_key_sql = "time_updated * 1000" if connection.dialect.name == "sqlite" else \
+                "FLOOR(time_updated * 1000)"
+            connection.execute(text(f"UPDATE {quoted_name} SET time_key = CAST({time_key_sql} AS BIGINT)"))
+            table.append_column(Column("time_key", BigInteger))
+
+        for index in time_indexes(table, connection.dialect.name):
+            log.info(f"Creating index '{index.name}'...")
+            index.create(connection)
+
+
+def configure_sqlite_engine(engine: AsyncEngine, sqlite_profile: dict = None):
+    # WAL and incremental vacuum are always on. The profile lets us trade durability for fewer fsyncs and less write
+    # amplification, which matters a lot on SD cards
+    pragmas = ["journal_mode=WAL", "auto_vacuum=INCREMENTAL"]
+    for pragma, value in (sqlite_profile or {}).items():
+        if pragma not in SQLITE_PROFILE_PRAGMAS:
+            raise ValueError(f"Unsupported SQLite profile setting '{pragma}', expected one of {SQLITE_PROFILE_PRAGMAS}")
+        if not re.fullmatch(r"-?\w+", str(value)):
+            raise ValueError(f"Invalid value for SQLite profile setting '{pragma}': {value}")
+        pragmas.append(f"{pragma}={value}")
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+
+
+def get_engine(sql_connection_string: str, pool_settings: dict = None, sqlite_profile: dict = None) -> AsyncEngine:
+    # The ingest session and the data interface's writes share the one pool, and reads get their own (with their own
+    # limits), so that a burst of heavy chart requests can only ever wait on each other rather than on ingest
+    pool_settings = pool_settings or {}
+    for setting in pool_settings:
+        if setting not in POOL_SETTINGS:
+            raise ValueError(f"Unsupported pool setting '{setting}', expected one of {POOL_SETTINGS}")
+
+    engine_key = (sql_connection_string, tuple(sorted(pool_settings.items())))
+    if engine_key in _engines:
+        return _engines[engine_key]
+
+    engine_arguments = {setting: value for setting, value in pool_settings.items() if setting != "statement_timeout"}
+    is_sqlite = sql_connection_string.startswith("sqlite")
+    if is_sqlite and engine_arguments:
+        # SQLite defaults to opening a new connection every time, which has no limits to set
+        engine_arguments["poolclass"] = AsyncAdaptedQueuePool
+
+    if "statement_timeout" in pool_settings:
+        if sql_connection_string.startswith("postgresql+asyncpg"):
+            # Enforced by the server, which cancels the query itself rather than just giving up waiting on it
+            timeout_milliseconds = str(int(pool_settings["statement_timeout"] * 1000))
+            engine_arguments["connect_args"] = {"server_settings": {"statement_timeout": timeout_milliseconds}}
+        else:
+            log.warning("Statement timeouts are only supported with postgresql+asyncpg, ignoring it...")
+
+    engine = create_async_engine(sql_connection_string, **engine_arguments)
+    if is_sqlite:
+        configure_sqlite_engine(engine, sqlite_profile)
+
+    _engines[engine_key] = engine
+    return engine
+
+
+async def dispose_engines():
+    # Pooled connections hold on to their threads (with aiosqlite) and server connections, so they're closed on the
+    # way out rather than left for the interpreter to wait on
+    for engine in _engines.values():
+        await engine.dispose()
+    _engines.clear()
@@ -2,6 +2,8 @@ import argparse
 import configuration
 from communication.connect_devices import run_devices
 from communication.attach_observers import attach_observers
+from data_management.ring_buffer import DeviceRingBuffer
+from data_management import sql_utilities
 import logging
 import asyncio
 import signal
@@ -14,12 +16,22 @@ class DeviceDaemon:
         self.loop = loop
         self.stop_functions = []
         self.running_devices = {}
+        # Observers from outside the daemon (like the web interface's result cache), attached to every device
+        self.additional_observers = []
 
     async def run(self):
         asynchronous_tasks = []
 
         self.running_devices = await run_devices(self.config)
 
+        if "hot_history" in self.config:
+            for device in self.running_devices.values():
+                device.history = DeviceRingBuffer(self.config["hot_history"].get("capacity", 3600))
+
+        for observer in self.additional_observers:
+            for device in self.running_devices.values():
+                device.attach_observer(observer)
+
         if len(self.running_devices) == 0:
             log.error("No devices running!")
 
@@ -28,7 +40,10 @@ class DeviceDaemon:
             asynchronous_tasks.extend(observer_tasks)
             asynchronous_tasks.extend([device.run() for device in self.running_devices.values()])
 
-            await asyncio.gather(*asynchronous_tasks)
+            try:
+                await asyncio.gather(*asynchronous_tasks)
+            finally:
+                await sql_utilities.dispose_engines()
 
     async def stop(self, signal_type):
         log.info(f"Shutting down due to signal {signal_type}...")
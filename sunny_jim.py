@@ -11,6 +11,8 @@ from fastapi.templating import Jinja2Templates
 import signal
 from web_interface import endpoints
 from data_management.data_interface import DataInterface
+from data_management.result_cache import CachedDataInterface
+from communication.observers import ResultCacheObserver
 
 
 if __name__ == '__main__':
@@ -41,6 +43,8 @@ if __name__ == '__main__':
     endpoints.register_device_endpoints(web_app, daemon)
 
     data_interface = DataInterface.create_from_config(config)
+    if isinstance(data_interface, CachedDataInterface):
+        daemon.additional_observers.append(ResultCacheObserver(data_interface))
     endpoints.register_data_endpoints(web_app, data_interface, daemon)
 
     web_app.add_middleware(
@@ -6,7 +6,8 @@ from fastapi.responses import HTMLResponse
 from fastapi.requests import Request
 from device_daemon import DeviceDaemon
 from communication.devices import DeviceType, CommandType
-from data_management.data_interface import DataInterface
+from data_management.data_interface import DataInterface, QueryBudgetExceeded
+from web_interface.response_formats import format_result, stream_result_chunks
 
 def running_devices(daemon: DeviceDaemon):
     return daemon.running_devices
@@ -86,18 +87,145 @@ def register_device_endpoints(app: FastAPI, daemon: DeviceDaemon) -> None:
 
 def register_data_endpoints(app: FastAPI, data_interface: DataInterface, daemon: DeviceDaemon) -> None:
     @app.get("/data/{device_key}/past_minutes/")
-    async def get_past_minutes(device_key: str, minutes: int, columns: str = None):
+    async def get_past_minutes(request: Request, device_key: str, minutes: int, columns: str = None,
+                               max_points: int = None, downsample: str = "average"):
         device = device_from_key(device_key, daemon)
 
         if columns:
             columns = columns.split(",")
 
-        result = await data_interface.get_last_n_minutes(device.device_id, minutes, columns)
+        if max_points is not None and max_points < 2:
+            raise HTTPException(status_code=400, detail="max_points must be at least 2.")
+
+        try:
+            result = await data_interface.get_last_n_minutes(device.device_id, minutes, columns, max_points, downsample,
+                                                             device.history)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except QueryBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
 
         if len(result) == 0:
             raise HTTPException(status_code=404, detail=f"No data found for device {device_key}.")
 
-        return result
+        return format_result(request, result)
+
+    @app.get("/data/{device_key}/past_minutes/stream/")
+    async def stream_past_minutes(request: Request, device_key: str, minutes: int, columns: str = None):
+        device = device_from_key(device_key, daemon)
+
+        if columns:
+            columns = columns.split(",")
+
+        try:
+            chunks = data_interface.stream_last_n_minutes(device.device_id, minutes, columns)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+
+        return stream_result_chunks(request, chunks)
+
+    @app.get("/data/{device_key}/entries/")
+    async def get_entries_page(request: Request, device_key: str, page_size: int = 1000, columns: str = None,
+                               order: str = "desc", page_token: str = None):
+        # The token for the next page comes back in the Next-Page-Token header, which is missing on the last page
+        device = device_from_key(device_key, daemon)
+
+        if columns:
+            columns = columns.split(",")
+
+        try:
+            result, next_page_token = await data_interface.get_entries_page(device.device_id, page_size, columns,
+                                                                            order, page_token)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except QueryBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        return format_result(request, result, {"Next-Page-Token": next_page_token} if next_page_token else None)
+
+    @app.get("/data/aligned/")
+    async def get_aligned_minutes(request: Request, series: str, minutes: int, max_points: int = None,
+                                  tolerance: float = None):
+        # series is a list of device_key:column pairs, e.g. battery:current,inverter:pv_power,inverter:load_power,
+        # and the first device's samples set the times of the rows
+        aligned_series = {}
+        for pair in series.split(","):
+            device_key, _, column = pair.partition(":")
+            if not column:
+                raise HTTPException(status_code=400, detail=f"Expected device_key:column, got '{pair}'.")
+
+            device = device_from_key(device_key, daemon)
+            _, columns, _ = aligned_series.setdefault(device_key, (device.device_id, [], device.history))
+            if column != "time_updated" and column not in columns:
+                columns.append(column)
+
+        if max_points is not None and max_points < 2:
+            raise HTTPException(status_code=400, detail="max_points must be at least 2.")
+
+        try:
+            result = await data_interface.get_aligned_minutes(aligned_series, minutes, max_points, tolerance)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except QueryBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        if len(result) == 0:
+            raise HTTPException(status_code=404, detail=f"No data found for device {next(iter(aligned_series))}.")
+
+        return format_result(request, result)
+
+    @app.get("/data/{device_key}/range/")
+    async def get_range(request: Request, device_key: str, start: datetime.datetime, end: datetime.datetime,
+                        bucket: float, columns: str = None, aggregates: str = "avg"):
+        device = device_from_key(device_key, daemon)
+
+        if columns:
+            columns = columns.split(",")
+
+        try:
+            result = await data_interface.get_range_aggregates(device.device_id, start.timestamp(), end.timestamp(),
+                                                               bucket, columns, aggregates.split(","))
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except QueryBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        if len(result) == 0:
+            raise HTTPException(status_code=404, detail=f"No data found for device {device_key}.")
+
+        return format_result(request, result)
+
+    @app.get("/data/{device_key}/archive/")
+    async def get_archived_range(request: Request, device_key: str, start: datetime.datetime,
+                                 end: datetime.datetime, columns: str = None, table: str = "raw",
+                                 max_points: int = None, downsample: str = "average"):
+        # Reads history that has been exported to Parquet, from the raw or the per-minute summary table
+        device = device_from_key(device_key, daemon)
+
+        if columns:
+            columns = columns.split(",")
+
+        if max_points is not None and max_points < 2:
+            raise HTTPException(status_code=400, detail="max_points must be at least 2.")
+
+        try:
+            result = await data_interface.get_archived_range(device.device_id, start.timestamp(), end.timestamp(),
+                                                             columns, table, max_points, downsample)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except QueryBudgetExceeded as e:
+            raise HTTPException(status_code=413, detail=str(e))
+
+        if len(result) == 0:
+            raise HTTPException(status_code=404, detail=f"No archived data found for device {device_key}.")
+
+        return format_result(request, result)
 
     @app.get("/data/time_when_grid_last_on/")
     async def get_time_when_grid_last_on():
@@ -110,6 +238,31 @@ def register_data_endpoints(app: FastAPI, data_interface: DataInterface, daemon:
         
         return result
 
+    @app.get("/data/grid_outages/")
+    async def get_grid_outages(days: float = 7):
+        device = inverter_candidate(daemon)
+
+        try:
+            return await data_interface.get_grid_outages(device.device_id, days)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+
+    @app.get("/data/grid_outages/daily_totals/")
+    async def get_daily_outage_totals(days: int = 7):
+        device = inverter_candidate(daemon)
+
+        try:
+            return await data_interface.get_daily_outage_totals(device.device_id, days)
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+
+    @app.get("/data/cache_statistics/")
+    async def get_cache_statistics():
+        try:
+            return data_interface.get_cache_statistics()
+        except NotImplementedError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+
     @app.post("/data/summarise/{device_key}/")
     async def summarise_data(device_key: str, cutoff_time: datetime.datetime):
         device = device_from_key(device_key, daemon)
@@ -0,0 +1,114 @@
+import json
+import sys
+from array import array
+import msgpack
+from fastapi.requests import Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Arrow is a big dependency for a Raspberry Pi, so it's only offered when it's already installed
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def get_supported_media_types() -> list[str]:
+    media_types = [JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE]
+    if pyarrow is not None:
+        media_types.append(ARROW_MEDIA_TYPE)
+
+    return media_types
+
+
+def choose_media_type(accept_header: str, supported_media_types: list[str] = None,
+                      default_media_type: str = JSON_MEDIA_TYPE) -> str:
+    # Picks the supported type the client prefers most, falling back to the default for browsers, */* and anything
+    # unknown
+    preferences = []
+    for i, media_range in enumerate((accept_header or "").split(",")):
+        media_type, *parameters = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    pass
+        preferences.append((-quality, i, media_type))
+
+    supported_media_types = supported_media_types or get_supported_media_types()
+    for negative_quality, _, media_type in sorted(preferences):
+        if negative_quality < 0 and media_type in supported_media_types:
+            return media_type
+
+    return default_media_type
+
+
+def pack_column(values) -> dict:
+    # Float and integer columns go out as a single little-endian buffer rather than one msgpack value per sample.
+    # Missing floats become NaN, since a typed array has nowhere else to put them
+    if not values or not all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool))
+                             for value in values):
+        return {"type": "list", "values": list(values)}
+
+    if all(isinstance(value, int) for value in values):
+        packed = array("q", values)
+    else:
+        packed = array("d", (float("nan") if value is None else value for value in values))
+
+    if sys.byteorder != "little":
+        packed.byteswap()
+
+    return {"type": "float64" if packed.typecode == "d" else "int64", "values": packed.tobytes()}
+
+
+def encode_msgpack(result: dict) -> bytes:
+    return msgpack.packb({key: pack_column(values) for key, values in result.items()}, use_bin_type=True)
+
+
+def encode_arrow(result: dict) -> bytes:
+    table = pyarrow.table({key: list(values) for key, values in result.items()})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+def format_result(request: Request, result: dict, headers: dict = None):
+    # Column-wise results are returned as they are for JSON, which lets FastAPI encode them as it always has
+    media_type = choose_media_type(request.headers.get("accept"))
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return Response(encode_msgpack(result), media_type=media_type, headers={"Vary": "Accept", **(headers or {})})
+    if media_type == ARROW_MEDIA_TYPE:
+        return Response(encode_arrow(result), media_type=media_type, headers={"Vary": "Accept", **(headers or {})})
+    if headers:
+        return JSONResponse(result, headers={"Vary": "Accept", **headers})
+
+    return result
+
+
+async def encode_ndjson_chunks(chunks):
+    async for chunk in chunks:
+        keys = list(chunk.keys())
+        yield "".join(json.dumps(dict(zip(keys, row))) + "\n" for row in zip(*chunk.values()))
+
+
+async def encode_msgpack_chunks(chunks):
+    # Each chunk is its own msgpack map, and msgpack values are self-delimiting, so clients can unpack them as a stream
+    async for chunk in chunks:
+        yield encode_msgpack(chunk)
+
+
+def stream_result_chunks(request: Request, chunks) -> StreamingResponse:
+    media_type = choose_media_type(request.headers.get("accept"), [NDJSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE],
+                                   NDJSON_MEDIA_TYPE)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return StreamingResponse(encode_msgpack_chunks(chunks), media_type=media_type, headers={"Vary": "Accept"})
+
+    return StreamingResponse(encode_ndjson_chunks(chunks), media_type=media_type, headers={"Vary": "Accept"})
@@ -24,10 +24,10 @@ async function getData(api_server, api_port, api_endpoint, api_params = null) {
     return response.json();
 }
 
-async function setUpPlots(api_server, api_port, minutes) {
-    // Fetch data from the API
-    const batteryData = await getData(api_server, api_port, "data/battery/past_minutes/", `minutes=${minutes}&columns=time_updated%2Cstate_of_charge%2Cvoltage%2Ccurrent`);
-    const inverterData = await getData(api_server, api_port, "data/inverter/past_minutes/", `minutes=${minutes}&columns=time_updated%2Cload_power%2Cload_va%2Cpv_input_power%2Cpv_charge_current%2Cgrid_charge_current`);
+async function setUpPlots(api_server, api_port, minutes, max_points = 1000) {
+    // Fetch data from the API, downsampled on the server so that long windows don't send every sample
+    const batteryData = await getData(api_server, api_port, "data/battery/past_minutes/", `minutes=${minutes}&max_points=${max_points}&columns=time_updated%2Cstate_of_charge%2Cvoltage%2Ccurrent`);
+    const inverterData = await getData(api_server, api_port, "data/inverter/past_minutes/", `minutes=${minutes}&max_points=${max_points}&columns=time_updated%2Cload_power%2Cload_va%2Cpv_input_power%2Cpv_charge_current%2Cgrid_charge_current`);
 
     const batteryDateTimes = batteryData.time_updated.map(unix => new Date(unix * 1000));
     const inverterDateTimes = inverterData.time_updated.map(unix => new Date(unix * 1000));